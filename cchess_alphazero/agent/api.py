@@ -1,4 +1,4 @@
-from multiprocessing import connection, Pipe
+from multiprocessing import Pipe
 from threading import Thread
 
 import os
@@ -6,6 +6,9 @@ import numpy as np
 import shutil
 import tensorflow as tf
 
+from cchess_alphazero.agent.batcher import BatchScheduler
+from cchess_alphazero.agent.eval_cache import EvalCache
+from cchess_alphazero.agent.shm_pipe import SharedMemoryPipe, shared_memory_pipe
 from cchess_alphazero.config import Config
 from cchess_alphazero.lib.model_helper import load_best_model_weight, need_to_reload_best_model_weight
 from cchess_alphazero.lib.web_helper import http_request, download_file
@@ -22,6 +25,8 @@ class CChessModelAPI:
         self.config = config
         self.need_reload = True
         self.done = False
+        self.scheduler = None   # BatchScheduler of the prediction worker, holds the batch statistics
+        self.cache = None       # EvalCache of predictions of the current model
 
     def start(self, need_reload=True):
         self.need_reload = need_reload
@@ -30,7 +35,10 @@ class CChessModelAPI:
         prediction_worker.start()
 
     def get_pipe(self, need_reload=True):
-        me, you = Pipe()
+        if self.config.play.use_shared_memory:
+            me, you = shared_memory_pipe(self.agent_model.model.input_shape[1:])
+        else:
+            me, you = Pipe()
         self.pipes.append(me)
         self.need_reload = need_reload
         return you
@@ -39,6 +47,12 @@ class CChessModelAPI:
         if self.config.internet.distributed and self.need_reload:
             self.try_reload_model_from_internet()
         last_model_check_time = time()
+        pc = self.config.play
+        if pc.eval_cache_size > 0:
+            self.cache = EvalCache(pc.eval_cache_size, self.agent_model.digest)
+        self.scheduler = BatchScheduler(self.predict_on_batch, self.pipes, target_size=pc.predict_batch_size,
+                                        max_latency=pc.predict_max_latency, buckets=pc.predict_batch_buckets,
+                                        stats_interval=pc.predict_stats_interval, cache=self.cache)
         
         # Initialize variables before prediction
         with self.agent_model.graph.as_default():
@@ -49,37 +63,14 @@ class CChessModelAPI:
             if last_model_check_time + 600 < time() and self.need_reload:
                 self.try_reload_model()
                 last_model_check_time = time()
-            ready = connection.wait(self.pipes, timeout=0.001)
-            if not ready:
-                continue
-            data, result_pipes, data_len = [], [], []
-            for pipe in ready:
-                while pipe.poll():
-                    try:
-                        tmp = pipe.recv()
-                    except EOFError as e:
-                        logger.error(f"EOF error: {e}")
-                        pipe.close()
-                    else:
-                        data.extend(tmp)
-                        data_len.append(len(tmp))
-                        result_pipes.append(pipe)
-            if not data:
-                continue
-            data = np.asarray(data, dtype=np.float32)
-            with self.agent_model.graph.as_default():
-                with self.agent_model.session.as_default():
-                    policy_ary, value_ary = self.agent_model.model.predict_on_batch(data)
-            buf = []
-            k, i = 0, 0
-            for p, v in zip(policy_ary, value_ary):
-                buf.append((p, float(v)))
-                k += 1
-                if k >= data_len[i]:
-                    result_pipes[i].send(buf)
-                    buf = []
-                    k = 0
-                    i += 1
+            if self.cache is not None:
+                self.cache.validate(self.agent_model.digest)
+            self.scheduler.run_once()
+
+    def predict_on_batch(self, data):
+        with self.agent_model.graph.as_default():
+            with self.agent_model.session.as_default():
+                return self.agent_model.model.predict_on_batch(data)
 
     def try_reload_model(self, config_file=None):
         if config_file:
@@ -121,3 +112,6 @@ class CChessModelAPI:
 
     def close(self):
         self.done = True
+        for pipe in self.pipes:
+            if isinstance(pipe, SharedMemoryPipe):
+                pipe.unlink()
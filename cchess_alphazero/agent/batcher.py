@@ -0,0 +1,235 @@
+'''
+Dynamic batching of prediction requests for CChessModelAPI
+
+Requests of the players are queued and dispatched together once the batch reaches the
+target size, the oldest request reaches the latency deadline, or every active player is waiting.
+Batches are padded to fixed bucket sizes so the graph sees a few stable shapes.
+Positions found in the evaluation cache are answered without prediction.
+'''
+from collections import defaultdict
+from logging import getLogger
+from multiprocessing import connection
+from threading import Lock
+from time import time
+
+import numpy as np
+
+from cchess_alphazero.agent.shm_pipe import SharedMemoryPipe
+
+logger = getLogger(__name__)
+
+class BatchStats:
+    '''
+    Live statistics of the prediction batches
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time()
+            self.batches = 0
+            self.samples = 0                # planes requested
+            self.predicted = 0              # planes predicted, the others are answered by the cache
+            self.padded = 0                 # planes predicted including padding
+            self.requests = 0
+            self.queue_wait = 0             # total seconds requests waited in queue
+            self.max_queue_wait = 0
+            self.infer_time = 0             # total seconds spent in prediction
+            self.histogram = defaultdict(int)   # bucket size -> number of batches
+
+    def record(self, size, predicted, padded, waits, infer_time):
+        with self.lock:
+            self.batches += 1
+            self.samples += size
+            self.predicted += predicted
+            self.padded += padded
+            self.requests += len(waits)
+            self.queue_wait += sum(waits)
+            self.max_queue_wait = max(self.max_queue_wait, max(waits))
+            self.infer_time += infer_time
+            if padded:
+                self.histogram[padded] += 1
+
+    def summary(self):
+        with self.lock:
+            elapsed = max(time() - self.start_time, 1e-9)
+            return {
+                'batches': self.batches,
+                'samples': self.samples,
+                'samples_per_sec': self.samples / elapsed,
+                'avg_batch_size': self.samples / max(self.batches, 1),
+                'cached_ratio': 1 - self.predicted / max(self.samples, 1),
+                'padding_ratio': 1 - self.predicted / max(self.padded, 1),
+                'avg_queue_wait': self.queue_wait / max(self.requests, 1),
+                'max_queue_wait': self.max_queue_wait,
+                'avg_infer_time': self.infer_time / max(self.batches, 1),
+                'utilization': self.infer_time / elapsed,
+                'histogram': dict(sorted(self.histogram.items())),
+            }
+
+    def report(self):
+        s = self.summary()
+        return (f"NN batches {s['batches']}, {s['samples_per_sec']:.0f} samples/s, "
+                f"avg batch {s['avg_batch_size']:.1f}, cached {s['cached_ratio'] * 100:.1f}%, "
+                f"padding {s['padding_ratio'] * 100:.1f}%, "
+                f"queue wait {s['avg_queue_wait'] * 1000:.2f}/{s['max_queue_wait'] * 1000:.2f} ms (avg/max), "
+                f"inference {s['avg_infer_time'] * 1000:.2f} ms, utilization {s['utilization'] * 100:.1f}%, "
+                f"sizes {s['histogram']}")
+
+class BatchScheduler:
+    '''
+    Receive planes from pipes and predict them in batches
+
+    :param predict: function that maps planes of shape (batch, ...) to (policy, value)
+    :param pipes: list of model side pipe ends, new pipes can be appended at any time
+    :param cache: EvalCache shared by all pipes, None to disable
+    '''
+    def __init__(self, predict, pipes, target_size=256, max_latency=0.005, buckets=None,
+                 stats_interval=0, active_time=1, cache=None):
+        self.predict_fn = predict
+        self.pipes = pipes
+        self.target_size = target_size
+        self.max_latency = max_latency
+        self.buckets = sorted(buckets) if buckets else []
+        self.stats_interval = stats_interval
+        self.active_time = active_time      # a pipe is active if it sent a request in this many seconds
+        self.cache = cache
+        self.pending = []                   # (pipe, offset, planes, keys, arrival time)
+        self.pending_size = 0
+        self.last_seen = {}                 # pipe -> time of its last request
+        self.pad_buffers = {}               # bucket size -> preallocated planes
+        self.stats = BatchStats()
+        self.last_report = time()
+
+    def run_once(self, timeout=0.001):
+        '''
+        Wait for requests at most timeout seconds (or until the deadline of the queue),
+        then predict a batch if it is due
+        '''
+        if self.pending:
+            timeout = min(timeout, max(0, self.pending[0][4] + self.max_latency - time()))
+        ready = connection.wait(self.pipes, timeout=timeout)
+        if ready:
+            self.receive(ready)
+        if self.pending and self.batch_due():
+            self.dispatch()
+        if self.stats_interval and time() - self.last_report > self.stats_interval:
+            logger.info(self.stats.report())
+            if self.cache is not None:
+                logger.info(self.cache.report())
+            self.last_report = time()
+
+    def receive(self, ready):
+        now = time()
+        for pipe in ready:
+            while pipe.poll():
+                try:
+                    if isinstance(pipe, SharedMemoryPipe):
+                        offset, planes, keys = pipe.recv_batch()
+                    else:
+                        planes, keys = pipe.recv()
+                        offset, planes = None, np.asarray(planes, dtype=np.float32)
+                except EOFError:
+                    # the player closed its end of the pipe, e.g. at shutdown
+                    logger.debug("Pipe closed by the player")
+                    self.pipes.remove(pipe)
+                    self.last_seen.pop(pipe, None)
+                    pipe.close()
+                    break
+                else:
+                    self.pending.append((pipe, offset, planes, keys, now))
+                    self.pending_size += len(planes)
+                    self.last_seen[pipe] = now
+
+    def batch_due(self):
+        if self.pending_size >= self.target_size:
+            return True
+        now = time()
+        if now - self.pending[0][4] >= self.max_latency:
+            return True
+        # no more requests can come when every active player is waiting for prediction
+        waiting = set(req[0] for req in self.pending)
+        return all(pipe in waiting for pipe, seen in self.last_seen.items() if now - seen < self.active_time)
+
+    def dispatch(self):
+        requests, size = [], 0
+        while self.pending and (size == 0 or size + len(self.pending[0][2]) <= self.target_size):
+            req = self.pending.pop(0)
+            requests.append(req)
+            size += len(req[2])
+        self.pending_size -= size
+        start = time()
+        data = [req[2] for req in requests]
+        data = data[0] if len(data) == 1 else np.concatenate(data)
+        if self.cache is None:
+            policy_ary, value_ary, padded = self.predict(data)
+            predicted = size
+        else:
+            keys = np.concatenate([req[3] for req in requests])
+            policy_ary, value_ary, predicted, padded = self.predict_with_cache(data, keys)
+        value_ary = np.reshape(value_ary, -1)
+        end = time()
+        self.stats.record(size, predicted, padded, [start - req[4] for req in requests], end - start)
+        k = 0
+        for pipe, offset, planes, _, _ in requests:
+            l = len(planes)
+            if offset is not None:
+                pipe.send_prediction(offset, policy_ary[k:k + l], value_ary[k:k + l])
+            else:
+                pipe.send([(p, float(v)) for p, v in zip(policy_ary[k:k + l], value_ary[k:k + l])])
+            k += l
+
+    def predict_with_cache(self, data, keys):
+        '''
+        Answer the positions found in the cache and predict the others
+
+        :return: (policy, value, number of planes predicted, number of planes predicted including padding)
+        '''
+        cached = [self.cache.get(int(key)) for key in keys]
+        miss = [i for i, entry in enumerate(cached) if entry is None]
+        if len(miss) == len(data):
+            policy_ary, value_ary, padded = self.predict(data)
+            value_ary = np.reshape(value_ary, -1)
+        else:
+            hit = next(entry for entry in cached if entry is not None)
+            policy_ary = np.empty((len(data), len(hit[0])), dtype=np.float32)
+            value_ary = np.empty(len(data), dtype=np.float32)
+            for i, entry in enumerate(cached):
+                if entry is not None:
+                    policy_ary[i], value_ary[i] = entry
+            padded = 0
+            if miss:
+                policy, value, padded = self.predict(data[miss])
+                policy_ary[miss] = policy
+                value_ary[miss] = np.reshape(value, -1)
+        for i in miss:
+            self.cache.put(int(keys[i]), policy_ary[i], value_ary[i])
+        return policy_ary, value_ary, len(miss), padded
+
+    def predict(self, data):
+        '''
+        Predict planes padded to bucket sizes, batches larger than the largest bucket are split
+
+        :return: (policy, value, number of planes predicted including padding)
+        '''
+        n = len(data)
+        if not self.buckets:
+            policy, value = self.predict_fn(data)
+            return policy, value, n
+        largest = self.buckets[-1]
+        if n > largest:
+            results = [self.predict(data[i:i + largest]) for i in range(0, n, largest)]
+            return (np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results]),
+                    sum(r[2] for r in results))
+        size = next(b for b in self.buckets if b >= n)
+        if size != n:
+            buf = self.pad_buffers.get(size)
+            if buf is None or buf.shape[1:] != data.shape[1:]:
+                buf = np.zeros((size, ) + data.shape[1:], dtype=np.float32)
+                self.pad_buffers[size] = buf
+            buf[:n] = data
+            data = buf
+        policy, value = self.predict_fn(data)
+        return policy[:n], value[:n], size
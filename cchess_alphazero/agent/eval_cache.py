@@ -0,0 +1,79 @@
+'''
+Cache of neural network evaluations keyed by position hash
+
+Entries are (policy, value) of positions already predicted by the current model.
+The policy is kept over all labels in float16, since the prediction api does not know
+the legal moves of a position. The cache is emptied whenever the model digest changes.
+'''
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+ENTRY_OVERHEAD = 200    # approximate bytes of the dict slot, key, tuple and array header of an entry
+
+class EvalCache:
+    '''
+    LRU cache of NN evaluations with a size limit in MB
+
+    Key 0 means the position can not be cached and is never looked up.
+    '''
+    def __init__(self, size_mb=512, digest=None):
+        self.capacity = int(size_mb * 1024 * 1024)
+        self.entries = OrderedDict()    # key -> (policy, value), least recently used first
+        self.used = 0                   # bytes
+        self.digest = digest            # digest of the model that produced the entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def validate(self, digest):
+        '''
+        Drop all entries if the model changed
+        '''
+        if digest != self.digest:
+            with self.lock:
+                if self.entries:
+                    logger.info(f"模型已更新，清空评估缓存 ({len(self.entries)} 项)")
+                self.entries.clear()
+                self.used = 0
+                self.digest = digest
+
+    def get(self, key):
+        if not key:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return entry
+
+    def put(self, key, policy, value):
+        if not key or self.capacity <= 0:
+            return
+        policy = np.asarray(policy, dtype=np.float16)
+        size = policy.nbytes + ENTRY_OVERHEAD
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.used -= old[0].nbytes + ENTRY_OVERHEAD
+            self.entries[key] = (policy, float(value))
+            self.used += size
+            while self.used > self.capacity and self.entries:
+                _, (p, _) = self.entries.popitem(last=False)
+                self.used -= p.nbytes + ENTRY_OVERHEAD
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def report(self):
+        return (f"eval cache {len(self.entries)} entries, {self.used / 1024 / 1024:.1f}/"
+                f"{self.capacity / 1024 / 1024:.0f} MB, hit rate {self.hit_rate() * 100:.1f}% "
+                f"({self.hits}/{self.hits + self.misses})")
@@ -1,56 +1,192 @@
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, deque
 from logging import getLogger
-from threading import Lock, Condition
-import concurrent.futures.thread
+from threading import Lock, Condition, Thread
 
 import numpy as np
 import cchess_alphazero.environment.static_env as senv
+from cchess_alphazero.agent.shm_pipe import SharedMemoryPipe
 from cchess_alphazero.config import Config
-from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_move
-from time import time, sleep
-import gc 
+from cchess_alphazero.environment.array_board import KEY_MASK
+from cchess_alphazero.environment.plane_board import PlaneBoard
+from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_move, Mirrored_index, mirror_policy
+from time import time
 import sys
 
 logger = getLogger(__name__)
 
+EDGE_DTYPE = np.float32     # dtype of edge statistics
+MOVE_DTYPE = np.int16       # dtype of legal move indexes
+N, W, Q, P = range(4)       # rows of VisitState.edges
+POLL_TIMEOUT = 0.1          # seconds the receiver blocks on the pipe before checking whether the player is closed
+NODE_LOCK_STRIPES = 1024    # locks shared by all states of a tree, a power of two
+TRANSPOSITION_Q_EPSILON = 0.01  # graph search: an edge whose Q is this close to its child's value is searched on
+
 class VisitState:
+    '''
+    Edge statistics are stored as rows of edges, indexed by the slot of the move in legal_moves,
+    views of a NodePool slab when the node comes from a pool
+    '''
+    __slots__ = ('sum_n', 'visit', 'legal_moves', 'waiting', 'edges', 'value_sum', 'value_n')
+
     def __init__(self):
-        self.a = defaultdict(ActionState)   # key: action, value: ActionState
+        self.reset()
+
+    def reset(self):
         self.sum_n = 0                      # visit count
-        self.visit = []                     # thread id that has visited this state
-        self.p = None                       # policy of this state
-        self.legal_moves = None             # all leagal moves of this state
+        self.visit = None                   # (state, history, board) of searches waiting for this state
+        self.legal_moves = None             # all leagal moves of this state, indexes of ActionLabelsRed
         self.waiting = False                # is waiting for NN's predict
-        self.w = 0
+        self.edges = None                   # rows of N, W, Q and P of every legal move
+        self.value_sum = 0                  # values backed up through this state, by all parents
+        self.value_n = 0
 
+    def expand(self, legal_moves, pool=None):
+        if pool is not None:
+            pool.alloc_edges(self, legal_moves)
+            return
+        self.legal_moves = np.asarray(legal_moves, dtype=MOVE_DTYPE)
+        self.edges = np.zeros((4, len(legal_moves)), dtype=EDGE_DTYPE)
 
-class ActionState:
-    def __init__(self):
-        self.n = 0      # N(s, a) : visit count
-        self.w = 0      # W(s, a) : total action value
-        self.q = 0      # Q(s, a) = N / W : action value
-        self.p = 0      # P(s, a) : prior probability
+    @property
+    def n(self):
+        '''N(s, a) : visit count'''
+        return self.edges[N]
+
+    @property
+    def w(self):
+        '''W(s, a) : total action value'''
+        return self.edges[W]
+
+    @property
+    def q(self):
+        '''Q(s, a) = W / N : action value'''
+        return self.edges[Q]
+
+    @property
+    def prior(self):
+        '''P(s, a) : prior probability'''
+        return self.edges[P]
+
+class NodePool:
+    '''
+    Preallocated storage of search nodes
+
+    Edge statistics of all nodes live in a few large slabs and nodes are recycled,
+    so a search allocates almost nothing per simulation and the whole tree is released
+    by reset() instead of garbage collection.
+    '''
+    def __init__(self, chunk_size=1 << 16):
+        self.chunk_size = chunk_size        # edges per slab
+        self.stats = []                     # slabs of (n, w, q, prior), shape (4, chunk_size)
+        self.moves = []                     # slabs of legal moves, shape (chunk_size, )
+        self.chunk = 0                      # slab in use
+        self.top = 0                        # first free edge of the slab in use
+        self.nodes = []                     # nodes handed out
+        self.free_nodes = []                # nodes ready for reuse
+        self.lock = Lock()
+
+    def new_node(self):
+        with self.lock:
+            node = self.free_nodes.pop() if self.free_nodes else VisitState()
+            self.nodes.append(node)
+        return node
+
+    def alloc_edges(self, node, legal_moves):
+        k = len(legal_moves)
+        with self.lock:
+            if self.top + k > self.chunk_size:
+                self.chunk += 1
+                self.top = 0
+            if self.chunk == len(self.stats):
+                self.stats.append(np.zeros((4, self.chunk_size), dtype=EDGE_DTYPE))
+                self.moves.append(np.zeros(self.chunk_size, dtype=MOVE_DTYPE))
+            start, end = self.top, self.top + k
+            self.top = end
+            stats = self.stats[self.chunk]
+            moves = self.moves[self.chunk]
+        node.edges = stats[:, start:end]
+        node.legal_moves = moves[start:end]
+        node.legal_moves[:] = legal_moves
+
+    def reset(self):
+        '''
+        Recycle all nodes and edges, the nodes must not be used by any tree after this
+        '''
+        with self.lock:
+            for node in self.nodes:
+                node.reset()
+            self.free_nodes.extend(self.nodes)
+            self.nodes = []
+            self.clear_slabs()
+
+    def compact(self, keep):
+        '''
+        Recycle all nodes but keep, whose edges are moved to the start of the slabs,
+        so the slabs in use only depend on the size of the kept tree
+        '''
+        with self.lock:
+            kept = set(map(id, keep))
+            for node in self.nodes:
+                if id(node) not in kept:
+                    node.reset()
+                    self.free_nodes.append(node)
+            saved = [(node, node.edges.copy(), node.legal_moves.copy()) for node in keep if node.edges is not None]
+            self.nodes = list(keep)
+            self.clear_slabs()
+        for node, edges, legal_moves in saved:
+            self.alloc_edges(node, legal_moves)
+            node.edges[:] = edges
+
+    def clear_slabs(self):
+        for i in range(min(self.chunk + 1, len(self.stats))):
+            end = self.top if i == self.chunk else self.chunk_size
+            self.stats[i][:, :end] = 0
+        self.chunk = 0
+        self.top = 0
+
+    def memory_usage(self):
+        return sum(s.nbytes for s in self.stats) + sum(m.nbytes for m in self.moves)
+
+class StripedLocks:
+    '''
+    Fixed table of locks indexed by the Zobrist key of a state, states sharing a stripe share its lock
+
+    A search thread never holds two node locks at once, so sharing locks cannot deadlock.
+    '''
+    def __init__(self, stripes=NODE_LOCK_STRIPES, factory=Lock):
+        self.mask = stripes - 1
+        self.locks = [factory() for _ in range(stripes)]
+
+    def __getitem__(self, key):
+        return self.locks[key & self.mask]
 
 class CChessPlayer:
     def __init__(self, config: Config, search_tree=None, pipes=None, play_config=None, 
-            enable_resign=False, debugging=False, uci=False, use_history=False, side=0):
+            enable_resign=False, debugging=False, uci=False, use_history=False, side=0, node_pool=None):
         self.config = config
         self.play_config = play_config or self.config.play
         self.labels_n = len(ActionLabelsRed)
         self.labels = ActionLabelsRed
         self.move_lookup = {move: i for move, i in zip(self.labels, range(self.labels_n))}
         self.pipe = pipes                   # pipes that used to communicate with CChessModelAPI thread
-        self.node_lock = defaultdict(Lock)  # key: state key, value: Lock of that state
+        self.node_lock = StripedLocks()     # key: state key, value: Lock of that state
         self.use_history = use_history
+        self.history_states = {}            # key: state key, value: state, only used with history planes
+        # carry a PlaneBoard along the search path instead of encoding the leaf state, without history planes
+        self.incremental_planes = self.play_config.incremental_planes and not use_history
         self.increase_temp = False
 
         if search_tree is None:
-            self.tree = defaultdict(VisitState)  # key: state key, value: VisitState
+            self.tree = defaultdict(VisitState)  # key: Zobrist key of state, value: VisitState
         else:
             self.tree = search_tree
+        # nodes of the tree come from the pool, a pool passed in is reset by its owner, and so is
+        # a pool backing a tree passed in, which the caller still reads after close()
+        self.own_pool = node_pool is None and search_tree is None
+        self.node_pool = NodePool() if node_pool is None else node_pool
 
-        self.root_state = None
+        self.root_key = None
+        self.root_noise = None          # Dirichlet noise of the root, sampled once per search
 
         self.enable_resign = enable_resign
         self.debugging = debugging
@@ -59,48 +195,77 @@ class CChessPlayer:
         self.debug = {}
         self.side = side
 
-        self.s_lock = Lock()
-        self.run_lock = Lock()
         self.q_lock = Lock()            # queue lock
-        self.t_lock = Lock()
-        self.buffer_planes = []         # prediction queue
+        self.q_cond = Condition(self.q_lock)    # wakes the sender: states queued or the batch in flight returned
+        self.in_flight = False          # a batch is being predicted, only one at a time
+        self.buffer_states = []         # prediction queue of (state, state two plies before or None, board or None)
         self.buffer_history = []
+        self.buffer_keys = []           # keys of the evaluation cache, 0 if not cacheable
+        self.buffer_mirrored = []       # whether the mirrored state is sent
 
-        self.all_done = Lock()
-        self.num_task = 0
+        # search workers run simulations and backups from the task queue
+        self.task_lock = Lock()
+        self.task_ready = Condition(self.task_lock)     # wakes the search workers
+        self.search_done = Condition(self.task_lock)    # wakes action() when simulations finish
+        self.tasks = deque()            # (function, args)
+        self.sim_budget = 0             # simulations of the running search
+        self.sim_started = 0
+        self.sim_finished = 0
+        self.root_search = None         # (state, key, real history, PlaneBoard or None) of the running search
         self.done_tasks = 0
         self.uci = uci
         self.no_act = None
 
         self.job_done = False
+        self.choosing = False           # the search thread chooses the move, stop comes too late
+        self.forced = False             # the last move was played by forced_move_shortcut without search
+        self.threads = []               # started by the first search
 
-        self.executor = ThreadPoolExecutor(max_workers=self.play_config.search_threads + 2)
-        self.executor.submit(self.receiver)
-        self.executor.submit(self.sender)
+    def start_threads(self):
+        self.threads = [Thread(target=self.receiver, name="receiver"), Thread(target=self.sender, name="sender")]
+        self.threads += [Thread(target=self.search_worker, name=f"search_worker_{i}")
+                         for i in range(self.play_config.search_threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
 
-    def close(self, wait=True):
+    def stop_threads(self, wait=True):
         self.job_done = True
+        with self.task_lock:
+            self.task_ready.notify_all()
+            self.search_done.notify_all()
+        with self.q_cond:
+            self.q_cond.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def close(self, wait=True):
+        self.stop_threads(wait)
         del self.tree
-        gc.collect()
-        if self.executor is not None:
-            self.executor.shutdown(wait=wait)
+        if self.own_pool:
+            self.node_pool.reset()
 
     def close_and_return_action(self, state, turns, no_act=None):
-        self.job_done = True
-        if self.executor is not None:
-            self.executor.shutdown(wait=False)
-            # self.executor = None
-            self.executor._threads.clear()
-            concurrent.futures.thread._threads_queues.clear()
-        policy, resign = self.calc_policy(state, turns, no_act)
+        '''
+        Stop the search and choose the move from the visits so far,
+        None if the search has finished and the search thread returns its move
+        '''
+        with self.task_lock:
+            if self.choosing:
+                return None
+            self.job_done = True
+        self.stop_threads(wait=False)
+        key = senv.state_key(state)
+        policy, resign = self.calc_policy(key, turns, no_act)
         if resign:  # resign
             return None
         if no_act is not None:
             for act in no_act:
                 policy[self.move_lookup[act]] = 0
         my_action = int(np.random.choice(range(self.labels_n), p=self.apply_temperature(policy, turns)))
-        if state in self.debug:
-            _, value = self.debug[state]
+        if key in self.debug:
+            _, value = self.debug[key]
         else:
             value = 0
         return self.labels[my_action], value, self.done_tasks // 100
@@ -110,81 +275,273 @@ class CChessPlayer:
         send planes to neural network for prediction
         '''
         limit = 256                 # max prediction queue size
-        while not self.job_done:
-            self.run_lock.acquire()
-            with self.q_lock:
+        while True:
+            with self.q_cond:
+                while not self.job_done and (self.in_flight or not self.buffer_history):
+                    self.q_cond.wait()
+                if self.job_done:
+                    return
                 l = min(limit, len(self.buffer_history))
-                if l > 0:
-                    t_data = self.buffer_planes[0:l]
-                    # logger.debug(f"send queue size = {l}")
-                    self.pipe.send(t_data)
-                else:
-                    self.run_lock.release()
-                    sleep(0.001)
+                # the first l entries stay in the queue until the receiver gets their prediction
+                entries = self.buffer_states[0:l]
+                mirrored = self.buffer_mirrored[0:l]
+                t_keys = self.buffer_keys[0:l]
+                self.in_flight = True
+            self.pipe.send((self.encode_batch(entries, mirrored), t_keys))
 
     def receiver(self):
         '''
         receive policy and value from neural network
         '''
         while not self.job_done:
-            if self.pipe.poll(0.001):
-                rets = self.pipe.recv()
-            else:
+            if not self.pipe.poll(POLL_TIMEOUT):
                 continue
+            if self.job_done:
+                break       # the pipe may be handed to another player already
+            rets = self.pipe.recv()
             k = 0
-            with self.q_lock:
-                for ret in rets:
+            with self.q_cond:
+                for p, v in rets:
                     # logger.debug(f"NN ret, update tree buffer_history = {self.buffer_history}")
-                    self.executor.submit(self.update_tree, ret[0], ret[1], self.buffer_history[k])
-                    # self.update_tree(ret[0], ret[1], self.buffer_history[k])
+                    history = self.buffer_history[k]
+                    prior = self.leaf_prior(p, v, history[-1], self.buffer_mirrored[k])
+                    self.submit(self.update_tree, prior, v, history)
                     k = k + 1
-                self.buffer_planes = self.buffer_planes[k:]
+                self.buffer_states = self.buffer_states[k:]
                 self.buffer_history = self.buffer_history[k:]
-            self.run_lock.release()
+                self.buffer_keys = self.buffer_keys[k:]
+                self.buffer_mirrored = self.buffer_mirrored[k:]
+                self.in_flight = False
+                self.q_cond.notify()
+
+    def encode_batch(self, entries, mirrored, out=None):
+        '''
+        Input planes of the queued (state, last state, board) entries, encoded into out if given,
+        else in place in the shared memory slab if possible
+        '''
+        l = len(entries)
+        if out is None and isinstance(self.pipe, SharedMemoryPipe):
+            out = self.pipe.input_rows(l)
+        if self.incremental_planes:
+            t_data = out if out is not None else np.empty((l, 10, 9, 14), dtype=np.float32)
+            for i, (_, _, board) in enumerate(entries):
+                board.encode(t_data[i], mirrored[i])
+            return t_data
+        states = [state for state, _, _ in entries]
+        last_states = [last for _, last, _ in entries] if self.use_history else None
+        return senv.states_to_planes(states, last_states, out=out)
+
+    def leaf_prior(self, p, v, key, mirrored):
+        '''
+        Prior of the legal moves of an evaluated state from the predicted policy p
+        '''
+        legal_moves = self.tree[key].legal_moves
+        if mirrored:
+            legal_moves = Mirrored_index[legal_moves]
+        if self.debugging:
+            self.debug[key] = (mirror_policy(p) if mirrored else np.array(p), v)
+        # gather the prior of legal moves now, p may be a view of the transport's buffer
+        # which is reused by the next batch
+        return p[legal_moves]
+
+    def submit(self, fn, *args):
+        '''
+        Queue a task for the search workers
+        '''
+        with self.task_lock:
+            self.tasks.append((fn, args))
+            self.task_ready.notify()
+
+    def search_worker(self):
+        '''
+        Run queued simulations and backups until the player is closed
+        '''
+        while True:
+            with self.task_lock:
+                while not self.tasks and not self.job_done:
+                    self.task_ready.wait()
+                if self.job_done:
+                    return
+                fn, args = self.tasks.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"Search task {fn.__name__} error: {e}")
+
+    def start_simulation(self):
+        '''
+        Queue one more simulation from the root, called with task_lock held
+        '''
+        state, key, hist, root_board = self.root_search
+        board = root_board.copy() if root_board is not None else None
+        self.sim_started += 1
+        self.tasks.append((self.MCTS_search, (state, key, [key], True, hist, board)))
+        self.task_ready.notify()
+
+    def finish_simulation(self):
+        with self.task_lock:
+            self.sim_finished += 1
+            self.done_tasks += 1
+            if self.play_config.search_early_stop and self.sim_started < self.sim_budget \
+                    and self.sim_finished % self.play_config.search_threads == 0 \
+                    and self.can_stop_early(self.root_search[1], self.sim_budget - self.sim_finished,
+                                            self.sim_started - self.sim_finished):
+                self.sim_budget = self.sim_started      # only wait for the simulations in flight
+            if self.sim_started < self.sim_budget:
+                self.start_simulation()
+            if self.sim_finished >= self.sim_budget or (self.uci and self.done_tasks % 100 == 0):
+                self.search_done.notify_all()
 
     def action(self, state, turns, no_act=None, depth=None, infinite=False, hist=None, increase_temp=False) -> str:
-        self.all_done.acquire(True)
-        self.root_state = state
+        if self.play_config.search_mode == 'batched':
+            return self.run_search(self.action_steps(state, turns, no_act, depth, infinite, hist, increase_temp))
+        key, budget, hist = self.begin_search(state, no_act, depth, infinite, hist, increase_temp)
+        forced = self.play_forced_move(state, key, no_act, budget)
+        if forced is not None:
+            return forced
+        depth = 0
+        start_time = time()
+        # MCTS search: keep search_threads simulations running until the budget is used up
+        if budget > 0:
+            if not self.threads:
+                self.start_threads()
+            root_board = PlaneBoard(state) if self.incremental_planes else None
+            with self.task_lock:
+                self.root_search = (state, key, hist, root_board)
+                self.sim_budget = budget
+                self.sim_started = 0
+                self.sim_finished = 0
+                for _ in range(min(self.play_config.search_threads, budget)):
+                    self.start_simulation()
+            while True:
+                with self.task_lock:
+                    self.search_done.wait_for(lambda: self.sim_finished >= self.sim_budget or self.job_done
+                                              or (self.uci and depth != self.done_tasks // 100))
+                    finished = self.sim_finished >= self.sim_budget or self.job_done
+                if self.uci and depth != self.done_tasks // 100:
+                    # info depth xx pv xxx
+                    depth = self.done_tasks // 100
+                    _, value = self.debug[key]
+                    self.print_depth_info(state, turns, start_time, value, no_act)
+                if finished:
+                    break
+            if self.sim_finished < budget and not self.job_done:
+                self.log_early_stop(budget, self.sim_finished, start_time)
+        if not self.claim_result():
+            return None, None       # stopped, close_and_return_action chooses the move
+        return self.choose_action(state, key, turns, no_act)
+
+    def action_steps(self, state, turns, no_act=None, depth=None, infinite=False, hist=None, increase_temp=False):
+        '''
+        action() with the batched search as a generator, which does not use the pipe:
+        it yields prediction requests (entries, mirrored, cache keys) as batched_search,
+        is sent back their list of (policy, value) and returns (action, policy)
+        '''
+        key, budget, hist = self.begin_search(state, no_act, depth, infinite, hist, increase_temp)
+        forced = self.play_forced_move(state, key, no_act, budget)
+        if forced is not None:
+            return forced
+        if budget > 0:
+            root_board = PlaneBoard(state) if self.incremental_planes else None
+            yield from self.batched_search(state, key, hist, root_board, budget, turns, time(), no_act)
+        if not self.claim_result():
+            return None, None
+        return self.choose_action(state, key, turns, no_act)
+
+    def run_search(self, steps):
+        '''
+        Answer the prediction requests of a generator of action_steps through the pipe, return its result
+        '''
+        try:
+            request = next(steps)
+            while True:
+                entries, mirrored, keys = request
+                self.pipe.send((self.encode_batch(entries, mirrored), keys))
+                request = steps.send(self.pipe.recv())
+        except StopIteration as e:
+            return e.value
+
+    def begin_search(self, state, no_act, depth, infinite, hist, increase_temp):
+        '''
+        Set up the search of state, return its key, the number of simulations to run and the real history
+        '''
+        key = senv.state_key(state)
+        self.root_key = key
+        self.root_noise = None
+        self.choosing = False
+        self.forced = False
         self.no_act = no_act
         self.increase_temp = increase_temp
         if hist and len(hist) >= 5:
             hist = hist[-5:]
         done = 0
-        if state in self.tree:
-            done = self.tree[state].sum_n
+        if key in self.tree:
+            done = self.tree[key].sum_n
         if no_act or increase_temp or done == self.play_config.simulation_num_per_move:
             # logger.info(f"no_act = {no_act}, increase_temp = {increase_temp}")
             done = 0
         self.done_tasks = done
-        self.num_task = self.play_config.simulation_num_per_move - done
+        budget = self.play_config.simulation_num_per_move - done
         if depth:
-            self.num_task = depth - done if depth > done else 0
+            budget = depth - done if depth > done else 0
         if infinite:
-            self.num_task = 100000
-        depth = 0
-        start_time = time()
-        # MCTS search
-        if self.num_task > 0:
-            all_tasks = self.num_task
-            batch = all_tasks // self.config.play.search_threads
-            if all_tasks % self.config.play.search_threads != 0:
-                batch += 1
-            # logger.debug(f"all_task = {self.num_task}, batch = {batch}")
-            for iter in range(batch):
-                self.num_task = min(self.config.play.search_threads, all_tasks - self.config.play.search_threads * iter)
-                self.done_tasks += self.num_task
-                # logger.debug(f"iter = {iter}, num_task = {self.num_task}")
-                for i in range(self.num_task):
-                    self.executor.submit(self.MCTS_search, state, [state], True, hist)
-                self.all_done.acquire(True)
-                if self.uci and depth != self.done_tasks // 100:
-                    # info depth xx pv xxx
-                    depth = self.done_tasks // 100
-                    _, value = self.debug[state]
-                    self.print_depth_info(state, turns, start_time, value, no_act)
-        self.all_done.release()
+            budget = 100000
+        return key, budget, hist
+
+    def play_forced_move(self, state, key, no_act, budget):
+        '''
+        The only legal move of the state as the result of action() without search, if forced_move_shortcut,
+        None if there is a choice. Not used by UCI, which reports the score of the search.
+        '''
+        if not self.play_config.forced_move_shortcut or self.uci:
+            return None
+        moves = senv.get_legal_move_indexes(state)
+        if no_act:
+            banned = [self.move_lookup[mov] for mov in no_act]
+            moves = [mov for mov in moves if mov not in banned]
+        if len(moves) != 1:
+            return None
+        action = int(moves[0])
+        self.forced = True
+        logger.debug(f"Forced move {self.labels[action]}, saved {budget} simulations")
+        policy = np.zeros(self.labels_n)
+        policy[action] = 1
+        self.retain_subtree(*senv.step(state, action, key))
+        return self.labels[action], list(policy)
+
+    def can_stop_early(self, key, remaining, in_flight):
+        '''
+        Whether the most visited move of the root leads the second one by more visits than
+        the remaining simulations can give, the virtual losses of the simulations in flight aside
+        '''
+        node = self.tree.get(key)
+        if node is None or node.legal_moves is None or len(node.legal_moves) < 2:
+            return False
+        n = node.n
+        if self.no_act:
+            n = n[~np.isin(node.legal_moves, [self.move_lookup[mov] for mov in self.no_act])]
+            if len(n) < 2:
+                return False
+        second, best = np.partition(n, -2)[-2:]
+        return best - second - self.config.play.virtual_loss * in_flight > remaining
 
-        policy, resign = self.calc_policy(state, turns, no_act)
+    def log_early_stop(self, budget, finished, start_time):
+        saved = budget - finished
+        cost = time() - start_time
+        logger.debug(f"Early stop after {finished}/{budget} simulations, saved {saved} simulations "
+                     f"and about {cost / max(finished, 1) * saved:.2f}s")
+
+    def claim_result(self):
+        '''
+        Whether the search thread chooses the move and retains its subtree, False if the search
+        has been stopped and close_and_return_action chooses it from the tree as it is
+        '''
+        with self.task_lock:
+            self.choosing = not self.job_done
+            return self.choosing
+
+    def choose_action(self, state, key, turns, no_act):
+        policy, resign = self.calc_policy(key, turns, no_act)
 
         if resign:  # resign
             return None, list(policy)
@@ -193,203 +550,425 @@ class CChessPlayer:
                 policy[self.move_lookup[act]] = 0
 
         my_action = int(np.random.choice(range(self.labels_n), p=self.apply_temperature(policy, turns)))
+        self.retain_subtree(*senv.step(state, my_action, key))
         return self.labels[my_action], list(policy)
 
-    def MCTS_search(self, state, history=[], is_root_node=False, real_hist=None) -> float:
+    def retain_subtree(self, state, key):
+        '''
+        Make the state the root of the tree: the nodes which are not reachable from it by visited moves
+        are dropped and recycled, the visits of its subtree count toward the next search
+        '''
+        keep = {}
+        if key in self.tree:
+            keep[key] = self.tree[key]
+            stack = [(state, key)]
+            while stack:
+                state, key = stack.pop()
+                node = keep[key]
+                if node.legal_moves is None:
+                    continue
+                for slot in np.flatnonzero(node.n > 0):
+                    child_state, child_key = senv.step(state, int(node.legal_moves[slot]), key)
+                    if child_key in self.tree and child_key not in keep:
+                        keep[child_key] = self.tree[child_key]
+                        stack.append((child_state, child_key))
+        # the tree may be owned by the caller, it is updated in place
+        self.tree.clear()
+        self.tree.update(keep)
+        self.node_pool.compact(list(keep.values()))
+        if self.use_history:
+            self.history_states = {k: s for k, s in self.history_states.items() if k in keep}
+
+    def MCTS_search(self, state, key, history=[], is_root_node=False, real_hist=None, board=None) -> float:
         """
         Monte Carlo Tree Search
+
+        history = [key, slot, key, slot, ..., key], key is the Zobrist key of the state
+        and slot is the index of the action in legal_moves of that state
+        board: PlaneBoard of the state owned by this search, if incremental_planes
         """
         while True:
             # logger.debug(f"start MCTS, state = {state}, history = {history}")
             game_over, v, _ = senv.done(state)
             if game_over:
                 v = v * 2
-                self.executor.submit(self.update_tree, None, v, history)
+                self.submit(self.update_tree, None, v, history)
                 break
 
-            with self.node_lock[state]:
-                if state not in self.tree:
+            with self.node_lock[key]:
+                if key not in self.tree:
                     # Expand and Evaluate
-                    self.tree[state].sum_n = 1
-                    self.tree[state].legal_moves = senv.get_legal_moves(state)
-                    self.tree[state].waiting = True
+                    node = self.node_pool.new_node()
+                    self.tree[key] = node
+                    node.sum_n = 1
+                    node.expand(senv.get_legal_move_indexes(state), self.node_pool)
+                    node.waiting = True
+                    if self.use_history:
+                        self.history_states[key] = state
                     # logger.debug(f"expand_and_evaluate {state}, sum_n = {self.tree[state].sum_n}, history = {history}")
                     if is_root_node and real_hist:
-                        self.expand_and_evaluate(state, history, real_hist)
+                        self.expand_and_evaluate(state, history, real_hist, board)
                     else:
-                        self.expand_and_evaluate(state, history)
+                        self.expand_and_evaluate(state, history, board=board)
                     break
 
-                if state in history[:-1]: # loop
-                    for i in range(len(history) - 1):
-                        if history[i] == state:
-                            if senv.will_check_or_catch(state, history[i+1]):
-                                self.executor.submit(self.update_tree, None, -1, history)
-                            elif senv.be_catched(state, history[i+1]):
-                                self.executor.submit(self.update_tree, None, 1, history)
-                            else:
-                                # logger.debug(f"loop -> loss, state = {state}, history = {history[:-1]}")
-                                self.executor.submit(self.update_tree, None, 0, history)
-                            break
+                node = self.tree[key]
+                if key in history[0:-1:2]: # loop
+                    self.submit(self.update_tree, None, self.loop_value(state, key, history), history)
                     break
 
                 # Select
-                node = self.tree[state]
                 if node.waiting:
-                    node.visit.append(history)
+                    if node.visit is None:
+                        node.visit = []
+                    node.visit.append((state, history, board))
                     # logger.debug(f"wait for prediction state = {state}")
                     break
 
-                sel_action = self.select_action_q_and_u(state, is_root_node)
+                slot = self.select_action_q_and_u(key, is_root_node)
+                if slot is None:    # no legal move
+                    self.submit(self.update_tree, None, -1, history)
+                    break
 
                 virtual_loss = self.config.play.virtual_loss
-                self.tree[state].sum_n += 1
+                node.sum_n += 1
                 # logger.debug(f"node = {state}, sum_n = {node.sum_n}")
-                
-                action_state = self.tree[state].a[sel_action]
-                action_state.n += virtual_loss
-                action_state.w -= virtual_loss
-                action_state.q = action_state.w / action_state.n
-
-                # logger.debug(f"apply virtual_loss = {virtual_loss}, as.n = {action_state.n}, w = {action_state.w}, q = {action_state.q}")
-                
-                # if action_state.next is None:
-                history.append(sel_action)
-                state = senv.step(state, sel_action)
-                history.append(state)
-                # logger.debug(f"step action {sel_action}, next = {action_state.next}")
-
-    def select_action_q_and_u(self, state, is_root_node) -> str:
-        '''
-        Select an action with highest Q(s,a) + U(s,a)
-        '''
-        is_root_node = self.root_state == state
-        # logger.debug(f"select_action_q_and_u for {state}, root = {is_root_node}")
-        node = self.tree[state]
+
+                action = int(node.legal_moves[slot])
+                child_state, child_key = senv.step(state, action, key)
+                v = self.transposition_value(node, slot, child_key, history)
+
+                edges = node.edges
+                edges[N, slot] += virtual_loss
+                edges[W, slot] -= virtual_loss
+                edges[Q, slot] = edges[W, slot] / edges[N, slot]
+
+                history.append(slot)
+                history.append(child_key)
+                if v is not None:
+                    self.submit(self.update_tree, None, -v, history)
+                    break
+                state, key = child_state, child_key
+                if board is not None:
+                    board.move(action)
+
+    def batched_search(self, state, key, hist, root_board, budget, turns, start_time, no_act):
+        '''
+        Leaf parallel search in the calling thread, used when search_mode is 'batched':
+        descend up to search_batch_size paths with virtual loss, evaluate their leaves
+        with a single prediction and back up all of them. The tree is not locked.
+
+        A generator: a prediction is requested by yielding (entries, mirrored, cache keys)
+        of the leaves, see encode_batch, and their list of (policy, value) is sent back.
+        '''
+        batch_size = self.play_config.search_batch_size
+        early_stop = self.play_config.search_early_stop
+        limit = budget
+        started = finished = 0
+        depth = 0
+        resumed = []        # (state, key, history, board) of paths stopped at a leaf of the last batch
+        while finished < budget and not self.job_done:
+            paths = resumed
+            resumed = []
+            while started < budget and len(paths) < batch_size:
+                paths.append((state, key, [key], root_board.copy() if root_board is not None else None))
+                started += 1
+            leaves = []     # (history, request, cache key, mirrored) of the states to evaluate
+            backups = []    # (value, history) of the finished paths
+            for path in paths:
+                self.descend(*path, hist, leaves, backups, resumed)
+            if leaves:
+                rets = yield ([request for _, request, _, _ in leaves], [m for _, _, _, m in leaves],
+                              [k for _, _, k, _ in leaves])
+                for (history, _, _, m), (p, v) in zip(leaves, rets):
+                    leaf = history[-1]
+                    self.set_prior(self.tree[leaf], self.leaf_prior(p, v, leaf, m), v)
+                    backups.append((v, history))
+            for v, history in backups:
+                self.backup(v, history)
+            finished += len(backups)
+            self.done_tasks += len(backups)
+            if early_stop and started < budget and self.can_stop_early(key, budget - finished, started - finished):
+                budget = started        # only finish the paths in flight
+            if self.uci and depth != self.done_tasks // 100:
+                # info depth xx pv xxx
+                depth = self.done_tasks // 100
+                _, value = self.debug[key]
+                self.print_depth_info(state, turns, start_time, value, no_act)
+        if budget < limit and not self.job_done:
+            self.log_early_stop(limit, finished, start_time)
+
+    def descend(self, state, key, history, board, real_hist, leaves, backups, resumed):
+        '''
+        Select from the last state of history down to a leaf, the single threaded MCTS_search of batched_search
+
+        A new leaf is expanded and its request added to leaves, a terminal state or a loop adds its value
+        to backups, a path reaching a leaf of the same batch is added to resumed.
+        '''
+        is_root_node = len(history) == 1
+        virtual_loss = self.config.play.virtual_loss
+        while True:
+            game_over, v, _ = senv.done(state)
+            if game_over:
+                backups.append((v * 2, history))
+                return
+
+            if key not in self.tree:
+                # Expand
+                node = self.node_pool.new_node()
+                self.tree[key] = node
+                node.sum_n = 1
+                node.expand(senv.get_legal_move_indexes(state), self.node_pool)
+                node.waiting = True
+                if self.use_history:
+                    self.history_states[key] = state
+                request = self.leaf_request(state, history, real_hist if is_root_node else None, board)
+                leaves.append((history, ) + request)
+                return
+
+            node = self.tree[key]
+            if key in history[0:-1:2]: # loop
+                backups.append((self.loop_value(state, key, history), history))
+                return
+
+            # Select
+            if node.waiting:
+                resumed.append((state, key, history, board))
+                return
+
+            slot = self.select_action_q_and_u(key, is_root_node)
+            if slot is None:    # no legal move
+                backups.append((-1, history))
+                return
+
+            node.sum_n += 1
+            action = int(node.legal_moves[slot])
+            child_state, child_key = senv.step(state, action, key)
+            v = self.transposition_value(node, slot, child_key, history)
+
+            edges = node.edges
+            edges[N, slot] += virtual_loss
+            edges[W, slot] -= virtual_loss
+            edges[Q, slot] = edges[W, slot] / edges[N, slot]
+
+            history.append(slot)
+            history.append(child_key)
+            if v is not None:
+                backups.append((-v, history))
+                return
+            state, key = child_state, child_key
+            if board is not None:
+                board.move(action)
+            is_root_node = False
+
+    def backup(self, v, history):
+        '''
+        Back up the value of the last state of history and remove the virtual losses, without locks
+        '''
+        virtual_loss = self.config.play.virtual_loss
+        history.pop()
+        while history:
+            slot = history.pop()
+            key = history.pop()
+            v = - v
+            node = self.tree[key]
+            edges = node.edges
+            edges[N, slot] += 1 - virtual_loss
+            edges[W, slot] += v + virtual_loss
+            edges[Q, slot] = edges[W, slot] / edges[N, slot]
+            node.value_sum += v
+            node.value_n += 1
+
+    def transposition_value(self, node, slot, child_key, history):
+        '''
+        Graph search (search_graph): the child of an edge may have been searched through other parents.
+        If it has more visits than the edge and its value differs from the edge's Q, the simulation
+        stops there and backs up the value which makes the Q of the edge equal to the child's value,
+        instead of searching the subtree of the child again.
+
+        :return: value to back up for the player of node, None to search on
+        '''
+        if not self.play_config.search_graph:
+            return None
+        child = self.tree.get(child_key)
+        n = node.edges[N, slot]
+        if child is None or child.value_n <= n or child_key in history[0::2]:
+            return None
+        q_target = - child.value_sum / child.value_n
+        q_delta = q_target - node.edges[Q, slot]
+        if abs(q_delta) <= TRANSPOSITION_Q_EPSILON:
+            return None
+        return float(min(max(n * q_delta + q_target, -1), 1))
+
+    def loop_value(self, state, key, history):
+        '''
+        Value of a search path which returns to the state key: a perpetual check or chase
+        by the side to move loses, being chased wins, other repetitions are draws
+        '''
+        node = self.tree[key]
+        for i in range(0, len(history) - 1, 2):
+            if history[i] == key:
+                action = self.labels[node.legal_moves[history[i + 1]]]
+                if senv.will_check_or_catch(state, action, key):
+                    return -1
+                elif senv.be_catched(state, action):
+                    return 1
+                # logger.debug(f"loop -> loss, state = {state}, history = {history[:-1]}")
+                return 0
+
+    def select_action_q_and_u(self, key, is_root_node) -> int:
+        '''
+        Select an action with highest Q(s,a) + U(s,a), return its slot in legal_moves
+        '''
+        is_root_node = self.root_key == key
+        # logger.debug(f"select_action_q_and_u for {key}, root = {is_root_node}")
+        node = self.tree[key]
         legal_moves = node.legal_moves
 
-        # push p, the prior probability to the edge (node.p), only consider legal moves
-        if node.p is not None:
-            all_p = 0
-            for mov in legal_moves:
-                mov_p = node.p[self.move_lookup[mov]]
-                node.a[mov].p = mov_p
-                all_p += mov_p
-            # rearrange the distribution
-            if all_p == 0:
-                all_p = 1
-            for mov in legal_moves:
-                node.a[mov].p /= all_p
-            # release the temp policy
-            node.p = None
+        if len(legal_moves) == 0:
+            logger.error(f"No legal move, key = {key}")
+            return None
 
         # sqrt of sum(N(s, b); for all b)
-        xx_ = np.sqrt(node.sum_n + 1)  
+        xx_ = np.sqrt(node.sum_n + 1)
 
         e = self.play_config.noise_eps
         c_puct = self.play_config.c_puct
         dir_alpha = self.play_config.dirichlet_alpha
 
-        best_score = -99999999
-        best_action = None
-        move_counts = len(legal_moves)
+        p_ = node.prior
+        if is_root_node and e > 0:
+            if self.root_noise is None or len(self.root_noise) != len(legal_moves):
+                self.root_noise = np.random.dirichlet(dir_alpha * np.ones(len(legal_moves)))
+            p_ = (1 - e) * p_ + e * self.root_noise
+        # Q + U
+        score = node.q + c_puct * p_ * xx_ / (1 + node.n)
+        win = node.q > (1 - 1e-7)
+        if is_root_node and self.no_act:
+            banned = np.isin(legal_moves, [self.move_lookup[mov] for mov in self.no_act])
+            score[banned] = -np.inf
+            win[banned] = False
+            if banned.all():
+                logger.error(f"Best action is None, legal_moves = {legal_moves}, no_act = {self.no_act}")
+                return None
+        if win.any():
+            return int(np.argmax(win))
+        return int(np.argmax(score))
 
-        for mov in legal_moves:
-            if is_root_node and self.no_act and mov in self.no_act:
-                # logger.debug(f"mov = {mov}, no_act = {self.no_act}, continue")
-                continue
-            action_state = node.a[mov]
-            p_ = action_state.p
-            if is_root_node:
-                p_ = (1 - e) * p_ + e * np.random.dirichlet(dir_alpha * np.ones(move_counts))[0]
-            # Q + U
-            score = action_state.q + c_puct * p_ * xx_ / (1 + action_state.n)
-            # if score > 0.1 and is_root_node:
-            #     logger.debug(f"U+Q = {score:.2f}, move = {mov}, q = {action_state.q:.2f}")
-            if action_state.q > (1 - 1e-7):
-                best_action = mov
-                break
-            if score >= best_score:
-                best_score = score
-                best_action = mov
+    def expand_and_evaluate(self, state, history, real_hist=None, board=None):
+        '''
+        Evaluate the state, return its policy and value computed by neural network
 
-        if best_action == None:
-            logger.error(f"Best action is None, legal_moves = {legal_moves}, best_score = {best_score}")
-        # if is_root_node:
-        #     logger.debug(f"selected action = {best_action}, with U + Q = {best_score}")
-        return best_action
+        board: PlaneBoard of the state, encoded instead of the state if given
+        '''
+        entry, cache_key, mirrored = self.leaf_request(state, history, real_hist, board)
+        with self.q_cond:
+            self.buffer_states.append(entry)
+            self.buffer_history.append(history)
+            self.buffer_keys.append(cache_key)
+            self.buffer_mirrored.append(mirrored)
+            self.q_cond.notify()
+            # logger.debug(f"EAE append buffer_history history = {history}")
 
-    def expand_and_evaluate(self, state, history, real_hist=None):
+    def leaf_request(self, state, history, real_hist=None, board=None):
         '''
-        Evaluate the state, return its policy and value computed by neural network
+        Prediction request of a leaf: ((state, state two plies before or None, board), cache key, mirrored)
         '''
+        key = history[-1]
+        # ask NN about the canonical one of the state and its mirror, the policy is mirrored back in receiver
+        mirrored = False
+        if self.play_config.mirror_canonical and not real_hist:
+            state, mirrored = senv.canonical_state(state)
+            if mirrored:
+                key = senv.state_key(state)
+        last_state = None
         if self.use_history:
             if real_hist:
                 # logger.debug(f"real history = {real_hist}")
-                state_planes = senv.state_history_to_planes(state, real_hist)
+                if len(real_hist) >= 5:
+                    last_state = real_hist[-5]
+                cache_key = 0
             else:
                 # logger.debug(f"history = {history}")
-                state_planes = senv.state_history_to_planes(state, history)
+                hist = [self.history_states.get(k, k) for k in history[-5:]]
+                if mirrored:
+                    hist = [senv.mirror_state(h) if isinstance(h, str) else h for h in hist]
+                # the planes depend on the state two plies before as well
+                if len(history) < 5:
+                    cache_key = key
+                else:
+                    last_state = hist[0]
+                    last_key = senv.state_key(hist[0]) if mirrored else history[-5]
+                    cache_key = hash((key, last_key)) & KEY_MASK
         else:
-            state_planes = senv.state_to_planes(state)
-        with self.q_lock:
-            self.buffer_planes.append(state_planes)
-            self.buffer_history.append(history)
-            # logger.debug(f"EAE append buffer_history history = {history}")
+            cache_key = key
+        return (state, last_state, board), cache_key, mirrored
+
+    def set_prior(self, node, prior, v):
+        node.value_sum += v
+        node.value_n += 1
+        # rearrange the distribution, only consider legal moves
+        all_p = prior.sum()
+        if all_p == 0:
+            all_p = 1
+        np.divide(prior, all_p, out=node.prior)
+        node.waiting = False
 
-    def update_tree(self, p, v, history):
-        state = history.pop()
-
-        if p is not None:
-            with self.node_lock[state]:
-                # logger.debug(f"return from NN state = {state}, v = {v}")
-                node = self.tree[state]
-                node.p = p
-                node.waiting = False
-                if self.debugging:
-                    self.debug[state] = (p, v)
-                for hist in node.visit:
-                    self.executor.submit(self.MCTS_search, state, hist)
-                node.visit = []
+    def update_tree(self, prior, v, history):
+        '''
+        prior: policy of the legal moves of the evaluated state, None if the state is not evaluated by NN
+        '''
+        key = history.pop()
+
+        if prior is not None:
+            with self.node_lock[key]:
+                # logger.debug(f"return from NN key = {key}, v = {v}")
+                node = self.tree[key]
+                self.set_prior(node, prior, v)
+                if node.visit is not None:
+                    for state, hist, board in node.visit:
+                        self.submit(self.MCTS_search, state, key, hist, False, None, board)
+                    node.visit = None
 
         virtual_loss = self.config.play.virtual_loss
         # logger.debug(f"backup from {state}, v = {v}, history = {history}")
         while len(history) > 0:
-            action = history.pop()
-            state = history.pop()
+            slot = history.pop()
+            key = history.pop()
             v = - v
-            with self.node_lock[state]:
-                node = self.tree[state]
-                action_state = node.a[action]
-                action_state.n += 1 - virtual_loss
-                action_state.w += v + virtual_loss
-                action_state.q = action_state.w * 1.0 / action_state.n
-                # logger.debug(f"update value: state = {state}, action = {action}, n = {action_state.n}, w = {action_state.w}, q = {action_state.q}")
-
-        with self.t_lock:
-            self.num_task -= 1
-            # logger.debug(f"finish 1, remain num task = {self.num_task}")
-            if self.num_task <= 0:
-                self.all_done.release()
-
-    def calc_policy(self, state, turns, no_act) -> np.ndarray:
+            with self.node_lock[key]:
+                node = self.tree[key]
+                edges = node.edges
+                edges[N, slot] += 1 - virtual_loss
+                edges[W, slot] += v + virtual_loss
+                edges[Q, slot] = edges[W, slot] / edges[N, slot]
+                node.value_sum += v
+                node.value_n += 1
+
+        self.finish_simulation()
+
+    def calc_policy(self, key, turns, no_act) -> np.ndarray:
         '''
         calculate π(a|s0) according to the visit count
         '''
-        node = self.tree[state]
+        node = self.tree[key]
         policy = np.zeros(self.labels_n)
         max_q_value = -100
         debug_result = {}
 
-        for mov, action_state in node.a.items():
-            policy[self.move_lookup[mov]] = action_state.n
-            if no_act and mov in no_act:
-                policy[self.move_lookup[mov]] = 0
-                continue
+        if node.legal_moves is not None and len(node.legal_moves) > 0:
+            legal_moves = node.legal_moves
+            policy[legal_moves] = node.n
+            allowed = np.ones(len(legal_moves), dtype=bool)
+            if no_act:
+                allowed = ~np.isin(legal_moves, [self.move_lookup[mov] for mov in no_act])
+                policy[legal_moves[~allowed]] = 0
+            if allowed.any():
+                max_q_value = node.q[allowed].max()
             if self.debugging:
-                debug_result[mov] = (action_state.n, action_state.q, action_state.p)
-            if action_state.q > max_q_value:
-                max_q_value = action_state.q
+                for slot in np.flatnonzero(allowed):
+                    mov = self.labels[legal_moves[slot]]
+                    debug_result[mov] = (node.n[slot], node.q[slot], node.prior[slot])
 
         if max_q_value < self.play_config.resign_threshold and self.enable_resign and turns > self.play_config.min_resign_turn:
             return policy, True
@@ -413,23 +992,25 @@ class CChessPlayer:
         end_time = time()
         pv = ""
         i = 0
+        key = senv.state_key(state)
         while i < 20:
-            node = self.tree[state]
+            node = self.tree[key]
             bestmove = None
             root = True
             n = 0
-            if len(node.a) == 0:
+            if node.legal_moves is None or len(node.legal_moves) == 0:
                 break
-            for mov, action_state in node.a.items():
-                if action_state.n >= n:
+            for slot in range(len(node.legal_moves)):
+                mov = self.labels[node.legal_moves[slot]]
+                if node.n[slot] >= n:
                     if root and no_act and mov in no_act:
                         continue
-                    n = action_state.n
+                    n = node.n[slot]
                     bestmove = mov
             if bestmove is None:
-                logger.error(f"state = {state}, turns = {turns}, no_act = {no_act}, root = {root}, len(as) = {len(node.a)}")
+                logger.error(f"state = {state}, turns = {turns}, no_act = {no_act}, root = {root}, len(as) = {len(node.legal_moves)}")
                 break
-            state = senv.step(state, bestmove)
+            state, key = senv.step(state, bestmove, key)
             root = False
             if turns % 2 == 1:
                 bestmove = flip_move(bestmove)
@@ -437,8 +1018,8 @@ class CChessPlayer:
             pv += " " + bestmove
             i += 1
             turns += 1
-        if state in self.debug:
-            _, value = self.debug[state]
+        if key in self.debug:
+            _, value = self.debug[key]
             if turns % 2 != self.side:
                 value = -value
         score = int(value * 1000)
@@ -0,0 +1,161 @@
+'''
+Shared memory transport between CChessPlayer and CChessModelAPI
+
+Planes, position keys and predictions are written into preallocated slabs of a memory mapped file
+and only the (offset, length) of a batch goes through the underlying Pipe, which serves as doorbell.
+Both ends speak the same protocol as a multiprocessing Connection:
+the player sends (list of planes, list of keys) and receives a list of (policy, value).
+'''
+import mmap
+import os
+import tempfile
+import weakref
+from logging import getLogger
+from multiprocessing import Pipe
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+def _slab_size(input_shape, capacity, n_labels):
+    # float32 planes, policy and value, uint64 keys
+    return capacity * ((int(np.prod(input_shape)) + n_labels + 1) * 4 + 8)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class SharedMemoryPipe:
+    '''
+    One end of a shared memory channel, created by shared_memory_pipe()
+
+    The slabs are a ring of `capacity` rows, a batch always occupies contiguous rows,
+    so the model side reads a batch as one array and predictions are read in place.
+    Rows of a batch are reused once the ring wraps around, results must be consumed before that.
+    '''
+    def __init__(self, path, conn, input_shape, capacity, n_labels):
+        self.path = path
+        self.conn = conn
+        self.input_shape = tuple(input_shape)
+        self.capacity = capacity
+        self.n_labels = n_labels
+        self.head = 0               # first free row, only used by the sending side of planes
+        self.finalizer = None
+        self._map()
+
+    def _map(self):
+        plane_size = int(np.prod(self.input_shape))
+        size = _slab_size(self.input_shape, self.capacity, self.n_labels)
+        with open(self.path, 'r+b') as f:
+            self.mm = mmap.mmap(f.fileno(), size)
+        offset = 0
+        self.inputs = np.frombuffer(self.mm, dtype=np.float32, count=self.capacity * plane_size, offset=offset)
+        self.inputs = self.inputs.reshape((self.capacity, ) + self.input_shape)
+        offset += self.capacity * plane_size * 4
+        self.policy = np.frombuffer(self.mm, dtype=np.float32, count=self.capacity * self.n_labels, offset=offset)
+        self.policy = self.policy.reshape(self.capacity, self.n_labels)
+        offset += self.capacity * self.n_labels * 4
+        self.value = np.frombuffer(self.mm, dtype=np.float32, count=self.capacity, offset=offset)
+        offset += self.capacity * 4
+        self.keys = np.frombuffer(self.mm, dtype=np.uint64, count=self.capacity, offset=offset)
+
+    def __getstate__(self):
+        # the mapping is reopened by path in the receiving process
+        return {'path': self.path, 'conn': self.conn, 'input_shape': self.input_shape,
+                'capacity': self.capacity, 'n_labels': self.n_labels}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.head = 0
+        self.finalizer = None
+        self._map()
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def poll(self, timeout=0.0):
+        return self.conn.poll(timeout)
+
+    def next_offset(self, length):
+        if length > self.capacity:
+            raise ValueError(f"Batch size {length} exceeds shared memory capacity {self.capacity}")
+        return self.head if self.head + length <= self.capacity else 0
+
+    def input_rows(self, length):
+        '''
+        Player side: the rows the next batch of length planes will occupy,
+        planes encoded into them are sent without copy
+        '''
+        offset = self.next_offset(length)
+        return self.inputs[offset:offset + length]
+
+    def send(self, data):
+        '''
+        Player side: write a batch of (planes, keys) and ring the doorbell
+        '''
+        planes, keys = data
+        length = len(planes)
+        offset = self.next_offset(length)
+        rows = self.inputs[offset:offset + length]
+        if not (isinstance(planes, np.ndarray) and planes.ctypes.data == rows.ctypes.data):
+            for i, plane in enumerate(planes):
+                rows[i] = plane
+        self.keys[offset:offset + length] = keys
+        self.head = offset + length
+        self.conn.send((offset, length))
+
+    def recv(self):
+        '''
+        Player side: list of (policy, value) of the last batch, policies are views of the slab
+        '''
+        offset, length = self.conn.recv()
+        value = self.value[offset:offset + length].tolist()
+        return [(self.policy[offset + i], value[i]) for i in range(length)]
+
+    def recv_batch(self):
+        '''
+        Model side: planes and keys of a batch as contiguous arrays, without copy
+        '''
+        offset, length = self.conn.recv()
+        return offset, self.inputs[offset:offset + length], self.keys[offset:offset + length]
+
+    def send_prediction(self, offset, policy, value):
+        '''
+        Model side: write policy and value of a batch received at offset and ring the doorbell
+        '''
+        length = len(policy)
+        self.policy[offset:offset + length] = policy
+        self.value[offset:offset + length] = np.reshape(value, -1)
+        self.conn.send((offset, length))
+
+    def unlink(self):
+        '''
+        Remove the backing file, mappings already opened stay valid
+        '''
+        if self.finalizer is not None:
+            self.finalizer()
+
+    def close(self):
+        self.conn.close()
+        self.unlink()
+
+def shared_memory_pipe(input_shape, capacity=512, n_labels=2086):
+    '''
+    Create a shared memory channel
+
+    :return: (model side end, player side end), the file is removed when the model side end is closed
+    '''
+    fd, path = tempfile.mkstemp(prefix='cchess_', dir=SHM_DIR)
+    try:
+        os.ftruncate(fd, _slab_size(input_shape, capacity, n_labels))
+    finally:
+        os.close(fd)
+    me, you = Pipe()
+    server = SharedMemoryPipe(path, me, input_shape, capacity, n_labels)
+    server.finalizer = weakref.finalize(server, _remove, path)
+    client = SharedMemoryPipe(path, you, input_shape, capacity, n_labels)
+    return server, client
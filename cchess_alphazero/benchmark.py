@@ -0,0 +1,565 @@
+import gc
+import os
+import sys
+import tracemalloc
+from multiprocessing import Pipe
+from random import Random
+from threading import Condition, Lock, Thread
+from time import time, sleep
+
+import numpy as np
+
+_PATH_ = os.path.dirname(os.path.dirname(__file__))
+
+if _PATH_ not in sys.path:
+    sys.path.append(_PATH_)
+
+import cchess_alphazero.environment.static_env as senv
+from cchess_alphazero.agent.batcher import BatchScheduler
+from cchess_alphazero.agent.eval_cache import EvalCache
+from cchess_alphazero.agent.shm_pipe import SharedMemoryPipe, shared_memory_pipe
+from cchess_alphazero.config import Config
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed
+
+def sample_states(games=50, max_turns=120, seed=0):
+    '''
+    Collect positions from random playouts
+    '''
+    rnd = Random(seed)
+    states = []
+    for _ in range(games):
+        state = senv.INIT_STATE
+        for _ in range(max_turns):
+            if 's' not in state or 'S' not in state:
+                break
+            moves = senv.get_legal_moves(state)
+            if not moves:
+                break
+            states.append(state)
+            state = senv.step(state, rnd.choice(moves))
+    return states
+
+def reference_step(state, action):
+    board = senv.state_to_board(state)
+    board[int(action[3])][int(action[2])] = board[int(action[1])][int(action[0])]
+    board[int(action[1])][int(action[0])] = '.'
+    return senv.fliped_state(senv.board_to_state(board))
+
+def reference_expand(state):
+    board = senv.state_to_board(state)
+    moves = senv.get_board_legal_moves(board)
+    return [reference_step(state, mov) for mov in moves]
+
+def array_expand(state):
+    moves = senv.get_legal_moves(state)
+    return [senv.step(state, mov) for mov in moves]
+
+def timeit(fn, states, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time()
+        for state in states:
+            fn(state)
+        cost = time() - start
+        best = cost if best is None else min(best, cost)
+    return best
+
+def bench_movegen(games=50):
+    '''
+    Node expansion throughput: generate every legal move of a position and step into each child
+    '''
+    states = sample_states(games)
+    print(f"{len(states)} positions from {games} random games")
+    cases = [
+        ('movegen  reference', lambda s: senv.get_board_legal_moves(senv.state_to_board(s))),
+        ('movegen  array    ', senv.get_legal_move_indexes),
+        ('expand   reference', reference_expand),
+        ('expand   array    ', array_expand),
+        ('done     array    ', lambda s: senv.done(s, need_check=True)),
+    ]
+    for name, fn in cases:
+        cost = timeit(fn, states)
+        print(f"{name}: {len(states) / cost:10.0f} positions/sec ({cost * 1e6 / len(states):.1f} us/position)")
+
+def bench_repetition(games=20):
+    '''
+    Repetition adjudication of the first legal move of every position, with cold and warm caches
+    '''
+    states = sample_states(games)
+    cases = [(state, senv.state_key(state), senv.get_legal_moves(state)[0]) for state in states]
+    def adjudicate(clear):
+        start = time()
+        for state, key, action in cases:
+            if clear:
+                senv._check_or_catch_cache.clear()
+                senv._catch_cache.clear()
+            senv.will_check_or_catch(state, action, key)
+            senv.be_catched(state, action)
+        return (time() - start) * 1e6 / len(cases)
+    cold = adjudicate(True)
+    adjudicate(False)       # fill the caches
+    print(f"repetition cold: {cold:.1f} us/position, warm: {adjudicate(False):.1f} us/position")
+
+class StubModelAPI:
+    '''
+    Stand-in of CChessModelAPI answering every request with uniform policy and a small random value,
+    so that the search can be measured without a neural network
+
+    :param cost: simulated inference time, (seconds per batch, seconds per sample)
+    '''
+    def __init__(self, seed=0, use_shared_memory=True, input_shape=(10, 9, 14), config=None, cost=(0, 0)):
+        self.pipes = []
+        self.done = False
+        self.use_shared_memory = use_shared_memory
+        self.input_shape = input_shape
+        self.cost = cost
+        self.rnd = np.random.RandomState(seed)
+        self.policy = np.ones(len(ActionLabelsRed), dtype=np.float32) / len(ActionLabelsRed)
+        pc = (config or Config('mini')).play
+        self.cache = EvalCache(pc.eval_cache_size) if pc.eval_cache_size > 0 else None
+        self.scheduler = BatchScheduler(self.predict, self.pipes, target_size=pc.predict_batch_size,
+                                        max_latency=pc.predict_max_latency, buckets=pc.predict_batch_buckets,
+                                        cache=self.cache)
+
+    def start(self):
+        worker = Thread(target=self.predict_batch_worker, name="stub_prediction_worker")
+        worker.daemon = True
+        worker.start()
+
+    def get_pipe(self):
+        if self.use_shared_memory:
+            me, you = shared_memory_pipe(self.input_shape)
+        else:
+            me, you = Pipe()
+        self.pipes.append(me)
+        return you
+
+    def predict(self, data):
+        if self.cost[0] or self.cost[1]:
+            sleep(self.cost[0] + self.cost[1] * len(data))
+        policy = np.broadcast_to(self.policy, (len(data), len(self.policy)))
+        value = self.rnd.uniform(-0.1, 0.1, size=len(data)).astype(np.float32)
+        return policy, value
+
+    def predict_batch_worker(self):
+        while not self.done:
+            self.scheduler.run_once()
+
+    def close(self):
+        self.done = True
+        for pipe in self.pipes:
+            if isinstance(pipe, SharedMemoryPipe):
+                pipe.unlink()
+
+def bench_transport(batch=256, rounds=200):
+    '''
+    Round trip of prediction batches between a player process and the model thread
+    '''
+    planes = [senv.state_to_planes(state) for state in sample_states(5)[:batch]]
+    for use_shared_memory in (False, True):
+        api = StubModelAPI(use_shared_memory=use_shared_memory)
+        api.start()
+        pipe = api.get_pipe()
+        start = time()
+        keys = [0] * len(planes)
+        for _ in range(rounds):
+            pipe.send((planes, keys))
+            rets = pipe.recv()
+        cost = time() - start
+        api.close()
+        name = 'shared memory' if use_shared_memory else 'pipe         '
+        print(f"{name}: {cost * 1000 / rounds:.2f} ms per batch of {len(rets)}")
+
+def bench_tree_memory(moves=10, sims=400, config_type='mini'):
+    '''
+    Memory cost of the search tree over a game: memory in use and nodes retained after every move,
+    GC tracked objects allocated per simulation
+    '''
+    from cchess_alphazero.agent.player import CChessPlayer
+    config = Config(config_type)
+    config.play.simulation_num_per_move = sims
+    config.play.eval_cache_size = 0         # only measure the player
+    api = StubModelAPI(config=config)
+    api.start()
+    player = CChessPlayer(config, pipes=api.get_pipe())
+    state = senv.INIT_STATE
+    gc.collect()
+    gc.disable()
+    tracemalloc.start()
+    base_bytes, _ = tracemalloc.get_traced_memory()
+    base_objects = gc.get_count()[0]
+    used, kept = [], []
+    start = time()
+    for turn in range(moves):
+        action, _ = player.action(state, turn)
+        state = senv.step(state, action)
+        used.append(tracemalloc.get_traced_memory()[0] - base_bytes)
+        kept.append(len(player.tree))
+    cost = time() - start
+    objects = gc.get_count()[0] - base_objects
+    tracemalloc.stop()
+    slab = player.node_pool.memory_usage()
+    start = time()
+    player.close()
+    gc.collect()
+    release = time() - start
+    gc.enable()
+    api.close()
+    print(f"{moves} moves x {sims} simulations: {cost:.2f}s")
+    print(f"memory after each move : {' '.join(f'{b / 1e6:.1f}' for b in used)} MB (edge slabs {slab / 1e6:.1f} MB)")
+    print(f"nodes kept by each move: {' '.join(str(n) for n in kept)}")
+    print(f"objects per simulation : {objects / (moves * sims):.1f}")
+    print(f"release time           : {release * 1000:.1f} ms")
+
+def bench_batching(players=4, moves=2, sims=200, cost=(0.002, 0.00005),
+                   settings=((256, 0.005), (64, 0.002), (16, 0.001))):
+    '''
+    Batch sizes and latency of the prediction scheduler with several players searching at once
+
+    :param settings: (target batch size, max latency) to compare
+    '''
+    from cchess_alphazero.agent.player import CChessPlayer
+    for target, latency in settings:
+        config = Config('mini')
+        config.play.simulation_num_per_move = sims
+        config.play.predict_batch_size = target
+        config.play.predict_max_latency = latency
+        api = StubModelAPI(config=config, cost=cost)
+        api.start()
+
+        def play(pipe):
+            player = CChessPlayer(config, pipes=pipe)
+            state = senv.INIT_STATE
+            for turn in range(moves):
+                action, _ = player.action(state, turn)
+                state = senv.step(state, action)
+            player.close()
+
+        threads = [Thread(target=play, args=(api.get_pipe(), )) for _ in range(players)]
+        start = time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        cost_time = time() - start
+        api.close()
+        print(f"target {target}, max latency {latency * 1000:.0f} ms: {cost_time:.2f}s")
+        print(f"    {api.scheduler.stats.report()}")
+
+def bench_concurrent_games(duration=5, sims=100, cost=(0.002, 0.00005), players=(1, 8), games=(16, 64, 128)):
+    '''
+    Self-play moves per second of players searching in threads with a pipe each,
+    against games advanced together in one thread with a shared batched evaluator
+
+    :param players: numbers of threaded players, one game each
+    :param games: numbers of concurrent games
+    '''
+    import copy
+    from cchess_alphazero.agent.player import CChessPlayer
+    from cchess_alphazero.worker.self_play_game import SelfPlayGame, ConcurrentGames
+    config = Config('mini')
+    config.play.simulation_num_per_move = sims
+    config.play.enable_resign_rate = 1
+    for n in players:
+        api = StubModelAPI(config=config, cost=cost)
+        api.start()
+        moves = [0] * n
+
+        def play(i, pipe, deadline):
+            player = CChessPlayer(config, pipes=pipe)
+            game = SelfPlayGame(config, player)
+            while time() < deadline and not game.game_over:
+                game.play(*game.action())
+                moves[i] += 1
+            player.close()
+
+        deadline = time() + duration
+        threads = [Thread(target=play, args=(i, api.get_pipe(), deadline)) for i in range(n)]
+        start = time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        cost_time = time() - start
+        api.close()
+        print(f"threaded players {n:3d}: {sum(moves) / cost_time:6.1f} moves/s, {api.scheduler.stats.report()}")
+    play_config = copy.copy(config.play)
+    play_config.search_mode = 'batched'
+    for n in games:
+        api = StubModelAPI(config=config, cost=cost)
+        api.start()
+        played = []
+
+        def new_game():
+            return SelfPlayGame(config, CChessPlayer(config, play_config=play_config))
+
+        start = time()
+        concurrent = ConcurrentGames(api.get_pipe(), n, new_game)
+        while time() - start < duration:
+            played += [game.turns for game in concurrent.step()]
+        cost_time = time() - start
+        moves = sum(played) + sum(game.turns for game in concurrent.games)
+        api.close()
+        print(f"concurrent games {n:3d}: {moves / cost_time:6.1f} moves/s, {api.scheduler.stats.report()}")
+
+def bench_playout_cap(duration=20, sims=800, fast_sims=100, rates=(1.0, 0.25)):
+    '''
+    Self-play throughput with playout cap randomization: moves per second and training samples
+    per second when only a share of the moves is searched in full
+    '''
+    from cchess_alphazero.agent.player import CChessPlayer
+    from cchess_alphazero.worker.self_play_game import SelfPlayGame
+    for rate in rates:
+        config = Config('mini')
+        config.play.simulation_num_per_move = sims
+        config.play.fast_simulation_num_per_move = fast_sims
+        config.play.full_search_rate = rate
+        config.play.enable_resign_rate = 1
+        api = StubModelAPI(config=config)
+        api.start()
+        player = CChessPlayer(config, pipes=api.get_pipe())
+        moves = samples = 0
+        start = time()
+        while time() - start < duration:
+            game = SelfPlayGame(config, player)
+            while not game.game_over and time() - start < duration:
+                game.play(*game.action())
+            moves += len(game.samples)
+            samples += sum(game.samples)
+            player.tree.clear()
+            player.node_pool.reset()
+        cost = time() - start
+        player.close()
+        api.close()
+        print(f"full search rate {rate:.2f}: {moves / cost:6.1f} moves/s, {samples / cost:6.1f} samples/s")
+
+def bench_early_stop(moves=6, sims=800, modes=('threaded', 'batched')):
+    '''
+    Time per move and simulations run with and without search_early_stop, with a peaked stub policy
+    the most visited move soon leads by more visits than remain
+    '''
+    from cchess_alphazero.agent.player import CChessPlayer
+    for mode in modes:
+        for early_stop in (False, True):
+            config = Config('mini')
+            config.play.simulation_num_per_move = sims
+            config.play.search_mode = mode
+            config.play.search_early_stop = early_stop
+            np.random.seed(0)
+            api = StubModelAPI(config=config)
+            api.policy = np.random.RandomState(1).dirichlet(np.full(len(api.policy), 0.05)).astype(np.float32)
+            api.start()
+            player = CChessPlayer(config, pipes=api.get_pipe())
+            state = senv.INIT_STATE
+            simulations = 0
+            start = time()
+            for turn in range(moves):
+                key = senv.state_key(state)
+                done = player.tree[key].sum_n if key in player.tree else 0
+                action, _ = player.action(state, turn)
+                simulations += player.done_tasks - done
+                state = senv.step(state, action)
+            cost = time() - start
+            player.close()
+            api.close()
+            print(f"{mode:8s} early stop {'on ' if early_stop else 'off'}: {cost / moves * 1000:7.1f} ms/move, "
+                  f"{simulations / moves:6.1f} simulations/move")
+
+class CountingLock:
+    '''
+    Lock recording how often and how long threads wait for it, the counters are only updated by the holder
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.acquired = 0
+        self.contended = 0          # acquisitions that found the lock held by another thread
+        self.wait = 0               # seconds spent waiting
+
+    def acquire(self, blocking=True):
+        if not self.lock.acquire(False):
+            if not blocking:
+                return False
+            start = time()
+            self.lock.acquire()
+            self.wait += time() - start
+            self.contended += 1
+        self.acquired += 1
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+def lock_report(locks):
+    acquired = sum(lock.acquired for lock in locks)
+    contended = sum(lock.contended for lock in locks)
+    wait = sum(lock.wait for lock in locks)
+    return f"{contended / max(acquired, 1) * 100:.1f}% contended, {wait * 1000:.0f} ms waited"
+
+def bench_search(moves=3, sims=800, settings=((1, 3), (4, 3), (10, 3), (20, 3), (50, 3), (10, 1), (50, 1)),
+                 batch_sizes=(8, 16, 32)):
+    '''
+    Simulations per second of the full threaded search against an instant stub network,
+    and of the single threaded batched search
+
+    :param settings: (search_threads, virtual_loss) to compare
+    :param batch_sizes: search_batch_size of the batched search, with virtual loss 3
+    '''
+    from cchess_alphazero.agent.player import CChessPlayer, StripedLocks
+    runs = [('threaded', threads, virtual_loss) for threads, virtual_loss in settings]
+    runs += [('batched', batch_size, 3) for batch_size in batch_sizes]
+    for mode, width, virtual_loss in runs:
+        config = Config('mini')
+        config.play.simulation_num_per_move = sims
+        config.play.search_mode = mode
+        config.play.search_threads = width
+        config.play.search_batch_size = width
+        config.play.virtual_loss = virtual_loss
+        config.play.eval_cache_size = 0
+        np.random.seed(0)
+        api = StubModelAPI(config=config)
+        api.start()
+        player = CChessPlayer(config, pipes=api.get_pipe())
+        player.node_lock = StripedLocks(factory=CountingLock)
+        player.q_lock = CountingLock()
+        player.q_cond = Condition(player.q_lock)
+        state = senv.INIT_STATE
+        api.scheduler.stats.reset()
+        start = time()
+        for turn in range(moves):
+            action, _ = player.action(state, turn)
+            state = senv.step(state, action)
+        cost = time() - start
+        stats = api.scheduler.stats.summary()
+        node_locks = player.node_lock.locks
+        queue_lock = player.q_lock
+        player.close()
+        api.close()
+        name = 'threads' if mode == 'threaded' else 'batch  '
+        print(f"{name} {width:3d}, virtual loss {virtual_loss}: {moves * sims / cost:7.0f} sims/s, "
+              f"{stats['samples'] / cost:7.0f} NN queries/s, avg batch {stats['avg_batch_size']:5.1f}")
+        if mode == 'threaded':
+            hottest = max(lock.wait for lock in node_locks) / max(sum(lock.wait for lock in node_locks), 1e-9)
+            print(f"    {len(node_locks)} node lock stripes {lock_report(node_locks)} "
+                  f"({hottest * 100:.0f}% on the hottest), queue lock {lock_report([queue_lock])}")
+
+def bench_graph(moves=3, sims=1600, modes=('threaded', 'batched')):
+    '''
+    Tree search against graph search (search_graph): simulations per second and
+    NN queries per simulation, the graph search saves the queries of transposed subtrees.
+    The stub policy is peaked, with a uniform policy the search is too shallow to meet transpositions.
+    '''
+    from cchess_alphazero.agent.player import CChessPlayer
+    for mode in modes:
+        for graph in (False, True):
+            config = Config('mini')
+            config.play.simulation_num_per_move = sims
+            config.play.search_mode = mode
+            config.play.search_graph = graph
+            config.play.eval_cache_size = 0
+            np.random.seed(0)
+            api = StubModelAPI(config=config)
+            api.policy = np.random.RandomState(1).dirichlet(np.full(len(api.policy), 0.05)).astype(np.float32)
+            api.start()
+            player = CChessPlayer(config, pipes=api.get_pipe())
+            state = senv.INIT_STATE
+            api.scheduler.stats.reset()
+            simulations = 0
+            start = time()
+            for turn in range(moves):
+                key = senv.state_key(state)
+                done = player.tree[key].sum_n if key in player.tree else 0
+                simulations += sims - done if done < sims else sims     # visits kept from the last move are not run
+                action, _ = player.action(state, turn)
+                state = senv.step(state, action)
+            cost = time() - start
+            stats = api.scheduler.stats.summary()
+            player.close()
+            api.close()
+            print(f"{mode:8s} {'graph' if graph else 'tree '}: {simulations / cost:7.0f} sims/s, "
+                  f"{stats['samples'] / simulations:.2f} NN queries per simulation")
+
+def bench_eval_cache(games=3, moves=6, sims=200, cost=(0.002, 0.00005)):
+    '''
+    Hit rate of the evaluation cache over consecutive games of one player
+    '''
+    from cchess_alphazero.agent.player import CChessPlayer
+    config = Config('mini')
+    config.play.simulation_num_per_move = sims
+    api = StubModelAPI(config=config, cost=cost)
+    api.start()
+    pipe = api.get_pipe()
+    for game in range(games):
+        player = CChessPlayer(config, pipes=pipe)
+        state = senv.INIT_STATE
+        start = time()
+        for turn in range(moves):
+            action, _ = player.action(state, turn)
+            state = senv.step(state, action)
+        player.close(wait=False)
+        print(f"game {game}: {time() - start:.2f}s, {api.cache.report()}")
+    api.close()
+
+def bench_encoding(batch=256, repeat=20):
+    '''
+    Cost per state of encoding planes: one state at a time, batched, batched into the inference slab
+    '''
+    states = sample_states(5)[:batch]
+    last_states = [None, None] + states[:-2]
+    server, client = shared_memory_pipe((10, 9, 14), capacity=batch)
+    for name, fn in [('state_to_planes loop     ', lambda: [senv.state_to_planes(s) for s in states]),
+                     ('states_to_planes         ', lambda: senv.states_to_planes(states)),
+                     ('states_to_planes (slab)  ', lambda: senv.states_to_planes(states, out=client.input_rows(batch))),
+                     ('states_to_planes history ', lambda: senv.states_to_planes(states, last_states)),
+                     ('states_to_packed_planes  ', lambda: senv.states_to_packed_planes(states))]:
+        start = time()
+        for _ in range(repeat):
+            fn()
+        print(f"{name}: {(time() - start) * 1e6 / (repeat * len(states)):.1f} us per state")
+    server.close()
+    # incremental planes: one move per ply of the search path and one encoding per leaf
+    from cchess_alphazero.environment.plane_board import PlaneBoard
+    paths = []
+    for state in states:
+        moves = senv.get_legal_move_indexes(state)
+        if len(moves):
+            paths.append((PlaneBoard(state), int(moves[0])))
+    out = np.empty((10, 9, 14), dtype=np.float32)
+    boards = [(board.copy(), move) for _ in range(repeat) for board, move in paths]
+    start = time()
+    for board, move in boards:
+        board.move(move)
+    move_cost = (time() - start) / len(boards)
+    start = time()
+    for _ in range(repeat):
+        for board, _ in paths:
+            board.encode(out)
+    encode_cost = (time() - start) / (repeat * len(paths))
+    print(f"PlaneBoard.move          : {move_cost * 1e6:.1f} us per ply")
+    print(f"PlaneBoard.encode        : {encode_cost * 1e6:.1f} us per leaf")
+
+BENCHES = {
+    'movegen': bench_movegen,
+    'repetition': bench_repetition,
+    'encoding': bench_encoding,
+    'tree_memory': bench_tree_memory,
+    'transport': bench_transport,
+    'batching': bench_batching,
+    'eval_cache': bench_eval_cache,
+    'search': bench_search,
+    'graph': bench_graph,
+    'playout_cap': bench_playout_cap,
+    'early_stop': bench_early_stop,
+    'concurrent_games': bench_concurrent_games,
+}
+
+if __name__ == "__main__":
+    # python benchmark.py [name ...], all benchmarks by default
+    for name in sys.argv[1:] or list(BENCHES):
+        BENCHES[name]()
@@ -49,6 +49,8 @@ class ResourceConfig:
 
         self.play_data_dir = os.path.join(self.data_dir, "play_data")
         self.play_data_filename_tmpl = "play_%s.json"
+        self.play_data_binary_filename_tmpl = "play_%s.bin"
+        self.replay_buffer_dir = os.path.join(self.data_dir, "replay_buffer")
         self.self_play_game_idx_file = os.path.join(self.data_dir, "play_data_idx")
         self.play_record_filename_tmpl = "record_%s.qp"
         self.play_record_dir = os.path.join(self.data_dir, "play_record")
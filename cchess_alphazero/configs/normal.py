@@ -29,6 +29,8 @@ class PlayDataConfig:
         self.nb_game_in_file = 5
         self.max_file_num = 300
         self.nb_game_save_record = 1
+        self.binary_format = True       # write play data in the binary format of lib/data_helper
+        self.binary_planes = True       # also store the bit packed planes of every position
 
 
 class PlayConfig:
@@ -50,6 +52,23 @@ class PlayConfig:
         self.max_game_length = 100
         self.share_mtcs_info_in_self_play = False
         self.reset_mtcs_info_per_game = 5
+        self.use_shared_memory = True     # send planes and predictions through shared memory instead of pipes
+        self.predict_batch_size = 256       # target size of NN batches
+        self.predict_max_latency = 0.005    # seconds a request may wait for a fuller batch
+        self.predict_batch_buckets = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]    # batches are padded to these sizes
+        self.predict_stats_interval = 300   # seconds between logs of batch statistics, 0 to disable
+        self.eval_cache_size = 512          # MB of the NN evaluation cache, 0 to disable
+        self.mirror_canonical = True        # evaluate mirrored positions as one, by the canonical form
+        self.incremental_planes = True      # update input planes move by move along the search path
+        self.search_mode = 'threaded'       # 'threaded': search_threads workers, 'batched': leaf parallel in one thread
+        self.search_batch_size = 16         # paths descended per prediction in the batched search
+        self.concurrent_games = 1           # games played at once by a self-play process with the batched search, e.g. 64 ~ 256
+        self.search_graph = False           # share the values of transposed states between their parents (MCGS)
+        self.full_search_rate = 1.0         # playout cap randomization: share of self-play moves searched in full, e.g. 0.25
+        self.fast_simulation_num_per_move = 100  # simulations of the other moves, which are not training samples
+        self.search_early_stop = False      # stop a search once the most visited move cannot be overtaken,
+                                            # the best move is kept but the visit counts are not full
+        self.forced_move_shortcut = False   # play the only legal move without search, not a training sample
 
 
 class TrainerConfig:
@@ -72,6 +91,11 @@ class TrainerConfig:
             (400000, 0.0001),
         ]
         self.sl_game_step = 2000
+        self.mirror_augmentation = False    # also train on every position mirrored left-right
+        self.use_replay_buffer = True      # keep the last dataset_size positions in a memory mapped ring buffer
+        self.streaming_input = False       # decode play data in background while training, overrides use_replay_buffer
+        self.shuffle_buffer_size = 100000    # positions mixed together by the streaming input
+        self.prefetch_batches = 10
 
 class ModelConfig:
     def __init__(self):
@@ -0,0 +1,338 @@
+'''
+Array-backed chess engine used by static_env.
+
+A position is the state string expanded into a 99-byte mailbox (10 rows of 9 squares,
+each row followed by a border byte, in the same row order as the state string).
+Square ``row * 10 + col`` maps to board coordinates ``x = col, y = 9 - row``, and
+flipping the side to move is just reversing the array (``sq -> 98 - sq``).
+
+Pieces of the side to move are 1 ~ 7, opponent pieces are 9 ~ 15 (piece | OPPONENT),
+ordered as Fen_2_Idx. Moves are integer indexes of ActionLabelsRed.
+
+Positions are identified by 64-bit Zobrist keys. The tables satisfy
+``ZOBRIST[98 - sq][piece ^ OPPONENT] == flip_key(ZOBRIST[sq][piece])``, so the key of the
+flipped position is ``flip_key(key)`` and keys can be updated incrementally move by move.
+'''
+from random import Random
+
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, Fen_2_Idx
+
+BOARD_HEIGHT = 10
+BOARD_WIDTH = 9
+ROW_STRIDE = 10
+ARRAY_SIZE = BOARD_HEIGHT * ROW_STRIDE - 1
+
+EMPTY = 0
+PAWN, CANNON, ROOK, KNIGHT, ELEPHANT, MANDARIN, KING = range(1, 8)
+OPPONENT = 8
+BORDER = 32
+
+def square(x, y):
+    return (BOARD_HEIGHT - 1 - y) * ROW_STRIDE + x
+
+def coordinate(sq):
+    return sq % ROW_STRIDE, BOARD_HEIGHT - 1 - sq // ROW_STRIDE
+
+SQUARES = [square(x, y) for y in range(BOARD_HEIGHT) for x in range(BOARD_WIDTH)]
+
+# digits <-> runs of '.'
+_EXPAND = [(str(n).encode(), b'.' * n) for n in range(1, 10)]
+_COMPRESS = [(b'.' * n, str(n).encode()) for n in range(9, 0, -1)]
+# expanded state character -> piece code
+_CHAR_TO_PIECE = bytearray(256)
+_CHAR_TO_PIECE[ord('/')] = BORDER
+for _ch, _idx in Fen_2_Idx.items():
+    _CHAR_TO_PIECE[ord(_ch)] = _idx + 1 + (OPPONENT if _ch.islower() else 0)
+_CHAR_TO_PIECE = bytes(_CHAR_TO_PIECE)
+# swap the owner of every piece
+_SWAP_SIDE = bytes(c ^ OPPONENT if 0 < c < 16 and c != OPPONENT else c for c in range(256))
+
+MOVE_FROM = []      # label index -> source square
+MOVE_TO = []        # label index -> destination square
+MOVE_INDEX = [[-1] * ARRAY_SIZE for _ in range(ARRAY_SIZE)]    # [src][dst] -> label index
+for _i, _mov in enumerate(ActionLabelsRed):
+    _src = square(int(_mov[0]), int(_mov[1]))
+    _dst = square(int(_mov[2]), int(_mov[3]))
+    MOVE_FROM.append(_src)
+    MOVE_TO.append(_dst)
+    MOVE_INDEX[_src][_dst] = _i
+
+KEY_MASK = (1 << 64) - 1
+
+def flip_key(key):
+    '''
+    Key of the same position seen from the opponent's side
+    '''
+    return ((key << 32) | (key >> 32)) & KEY_MASK
+
+def _build_zobrist(seed=20180401):
+    # fixed seed: keys must be identical across processes and runs
+    rnd = Random(seed)
+    table = [[0] * 16 for _ in range(ARRAY_SIZE)]
+    for sq in SQUARES:
+        for piece in range(PAWN, KING + 1):
+            key = rnd.getrandbits(64)
+            table[sq][piece] = key
+            table[ARRAY_SIZE - 1 - sq][piece | OPPONENT] = flip_key(key)
+    return table
+
+ZOBRIST = _build_zobrist()
+
+def _on_board(x, y):
+    return 0 <= x < BOARD_WIDTH and 0 <= y < BOARD_HEIGHT
+
+def _in_palace(x, y):
+    return 3 <= x <= 5 and 0 <= y <= 2
+
+def _build_tables():
+    rays, knight, elephant, mandarin, king, pawn = {}, {}, {}, {}, {}, {}
+    for y in range(BOARD_HEIGHT):
+        for x in range(BOARD_WIDTH):
+            sq = square(x, y)
+            # up, down, left, right
+            rays[sq] = tuple(tuple(square(x + dx * k, y + dy * k) for k in range(1, 10) if _on_board(x + dx * k, y + dy * k))
+                             for dx, dy in [(0, 1), (0, -1), (-1, 0), (1, 0)])
+            knight[sq] = tuple((square(x + dx, y + dy), square(x + int(dx / 2), y + int(dy / 2)))
+                               for dx, dy in [(-1, -2), (1, -2), (2, -1), (2, 1), (1, 2), (-1, 2), (-2, 1), (-2, -1)]
+                               if _on_board(x + dx, y + dy))
+            elephant[sq] = tuple((square(x + dx, y + dy), square(x + dx // 2, y + dy // 2))
+                                 for dx, dy in [(-2, -2), (2, -2), (2, 2), (-2, 2)]
+                                 if _on_board(x + dx, y + dy) and y + dy <= 4)
+            mandarin[sq] = tuple(square(x + dx, y + dy) for dx, dy in [(-1, -1), (1, -1), (-1, 1), (1, 1)]
+                                 if _in_palace(x + dx, y + dy))
+            king[sq] = tuple(square(x + dx, y + dy) for dx, dy in [(0, -1), (1, 0), (0, 1), (-1, 0)]
+                             if _in_palace(x + dx, y + dy))
+            pawn[sq] = tuple(square(x + dx, y + dy) for dx, dy in [(0, 1), (-1, 0), (1, 0)]
+                             if _on_board(x + dx, y + dy) and (dx == 0 or y >= 5))
+    return rays, knight, elephant, mandarin, king, pawn
+
+RAYS, KNIGHT_MOVES, ELEPHANT_MOVES, MANDARIN_MOVES, KING_MOVES, PAWN_MOVES = _build_tables()
+
+def _build_attack_tables():
+    # the moves above reversed: squares a piece attacks a square from (with the knight leg or elephant eye)
+    knight, elephant, mandarin, king, pawn = ({sq: [] for sq in SQUARES} for _ in range(5))
+    for sq in SQUARES:
+        for to, leg in KNIGHT_MOVES[sq]:
+            knight[to].append((sq, leg))
+        for to, eye in ELEPHANT_MOVES[sq]:
+            elephant[to].append((sq, eye))
+        for to in MANDARIN_MOVES[sq]:
+            mandarin[to].append(sq)
+        for to in KING_MOVES[sq]:
+            king[to].append(sq)
+        for to in PAWN_MOVES[sq]:
+            pawn[to].append(sq)
+    return tuple({sq: tuple(v) for sq, v in table.items()} for table in (knight, elephant, mandarin, king, pawn))
+
+KNIGHT_ATTACKS, ELEPHANT_ATTACKS, MANDARIN_ATTACKS, KING_ATTACKS, PAWN_ATTACKS = _build_attack_tables()
+
+def expand_state(state):
+    '''
+    Expand the digits of a state string into '.', one byte per square
+    '''
+    expanded = state.encode('ascii')
+    for n, dots in _EXPAND:
+        expanded = expanded.replace(n, dots)
+    return expanded
+
+def compress_state(expanded):
+    for dots, n in _COMPRESS:
+        expanded = expanded.replace(dots, n)
+    return expanded.decode('ascii')
+
+def state_to_array(state):
+    '''
+    Expand a state string into the 99-byte piece array
+    '''
+    return expand_state(state).translate(_CHAR_TO_PIECE)
+
+def array_key(board):
+    key = 0
+    for sq in SQUARES:
+        piece = board[sq]
+        if piece != EMPTY:
+            key ^= ZOBRIST[sq][piece]
+    return key
+
+def state_key(state):
+    return array_key(state_to_array(state))
+
+def flip_array(board):
+    '''
+    The same position seen from the opponent's side
+    '''
+    return board[::-1].translate(_SWAP_SIDE)
+
+def generate_moves(board):
+    '''
+    Generate all legal moves of the side to move (lower rows), as ActionLabelsRed indexes
+    '''
+    moves = []
+    append = moves.append
+    for sq in SQUARES:
+        piece = board[sq]
+        if piece == EMPTY or piece > KING:
+            continue
+        index = MOVE_INDEX[sq]
+        if piece == ROOK:
+            for ray in RAYS[sq]:
+                for to in ray:
+                    target = board[to]
+                    if target == EMPTY:
+                        append(index[to])
+                    else:
+                        if target > OPPONENT:
+                            append(index[to])
+                        break
+        elif piece == CANNON:
+            for ray in RAYS[sq]:
+                screen = False
+                for to in ray:
+                    target = board[to]
+                    if not screen:
+                        if target == EMPTY:
+                            append(index[to])
+                        else:
+                            screen = True
+                    elif target != EMPTY:
+                        if target > OPPONENT:
+                            append(index[to])
+                        break
+        elif piece == PAWN:
+            for to in PAWN_MOVES[sq]:
+                target = board[to]
+                if target == EMPTY or target > OPPONENT:
+                    append(index[to])
+        elif piece == KNIGHT:
+            for to, leg in KNIGHT_MOVES[sq]:
+                target = board[to]
+                if board[leg] == EMPTY and (target == EMPTY or target > OPPONENT):
+                    append(index[to])
+        elif piece == ELEPHANT:
+            for to, eye in ELEPHANT_MOVES[sq]:
+                target = board[to]
+                if board[eye] == EMPTY and (target == EMPTY or target > OPPONENT):
+                    append(index[to])
+        elif piece == MANDARIN:
+            for to in MANDARIN_MOVES[sq]:
+                target = board[to]
+                if target == EMPTY or target > OPPONENT:
+                    append(index[to])
+        else:  # KING
+            for to in KING_MOVES[sq]:
+                target = board[to]
+                if target == EMPTY or target > OPPONENT:
+                    append(index[to])
+            # flying general: capture the opponent king on an open file
+            for to in RAYS[sq][0]:
+                target = board[to]
+                if target != EMPTY:
+                    if target == KING | OPPONENT:
+                        append(index[to])
+                    break
+    return moves
+
+def attacker(board, sq):
+    '''
+    Square of a piece of the side to move that can capture on sq, -1 if none
+    '''
+    for ray in RAYS[sq]:
+        screen = False
+        for frm in ray:
+            piece = board[frm]
+            if piece == EMPTY:
+                continue
+            if not screen:
+                if piece == ROOK:
+                    return frm
+                screen = True
+            else:
+                if piece == CANNON:
+                    return frm
+                break
+    for frm, leg in KNIGHT_ATTACKS[sq]:
+        if board[frm] == KNIGHT and board[leg] == EMPTY:
+            return frm
+    for frm in PAWN_ATTACKS[sq]:
+        if board[frm] == PAWN:
+            return frm
+    # mandarins, elephants and the king never leave their own half
+    for frm, eye in ELEPHANT_ATTACKS[sq]:
+        if board[frm] == ELEPHANT and board[eye] == EMPTY:
+            return frm
+    for frm in MANDARIN_ATTACKS[sq]:
+        if board[frm] == MANDARIN:
+            return frm
+    for frm in KING_ATTACKS[sq]:
+        if board[frm] == KING:
+            return frm
+    if board[sq] == KING | OPPONENT:
+        # flying general
+        for frm in RAYS[sq][1]:
+            piece = board[frm]
+            if piece != EMPTY:
+                if piece == KING:
+                    return frm
+                break
+    return -1
+
+def make_move(board, src, dst):
+    '''
+    The array after moving the piece on src to dst, still seen from the side that moved
+    '''
+    board = bytearray(board)
+    board[dst] = board[src]
+    board[src] = EMPTY
+    return bytes(board)
+
+def catches(board):
+    '''
+    Catches of the side to move: captures the opponent could not take back, as a set of
+    (piece, source, target, destination). Pawns on their own half, opponent pawns on the
+    opponent's half and exchanges of pieces of the same type do not catch.
+    '''
+    result = set()
+    for mov in generate_moves(board):
+        src, dst = MOVE_FROM[mov], MOVE_TO[mov]
+        target = board[dst]
+        if target == EMPTY:
+            continue
+        piece = board[src]
+        if (piece == PAWN and src >= 50) or (target == PAWN | OPPONENT and dst < 50) \
+                or piece == target ^ OPPONENT:
+            continue
+        if attacker(flip_array(make_move(board, src, dst)), ARRAY_SIZE - 1 - dst) >= 0:
+            continue    # defended
+        result.add((piece, src, target, dst))
+    return result
+
+def legal_moves(state):
+    return generate_moves(state_to_array(state))
+
+def move_squares(action):
+    if isinstance(action, str):
+        return square(int(action[0]), int(action[1])), square(int(action[2]), int(action[3]))
+    return MOVE_FROM[action], MOVE_TO[action]
+
+def apply_move(state, action, key=None):
+    '''
+    Make a move (label string or index) on the state
+
+    :param key: Zobrist key of the state, updated incrementally if given
+    :return: (state of the opponent's view after the move, whether a piece is captured, key of the new state)
+    '''
+    src, dst = move_squares(action)
+    expanded = bytearray(expand_state(state))
+    if expanded[src] == 46:     # '.'
+        raise ValueError(f"No chessman in {action}, state = {state}")
+    captured = expanded[dst] != 46
+    if key is not None:
+        moved = _CHAR_TO_PIECE[expanded[src]]
+        key ^= ZOBRIST[src][moved] ^ ZOBRIST[dst][moved]
+        if captured:
+            key ^= ZOBRIST[dst][_CHAR_TO_PIECE[expanded[dst]]]
+        key = flip_key(key)
+    expanded[dst] = expanded[src]
+    expanded[src] = 46
+    expanded.reverse()
+    return compress_state(expanded.swapcase()), captured, key
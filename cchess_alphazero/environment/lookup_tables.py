@@ -58,6 +58,12 @@ def flip_move(x):
 def flip_action_labels(labels):
     return [flip_move(x) for x in labels]
 
+def mirror_move(x):
+    '''
+    Mirror a move along the middle file (left <-> right)
+    '''
+    return str(8 - int(x[0])) + x[1] + str(8 - int(x[2])) + x[3]
+
 
 def create_action_labels():
     labels_array = []   # [col_src,row_src,col_dst,row_dst]
@@ -139,3 +145,12 @@ Unflipped_index = [ActionLabelsRed.index(x) for x in ActionLabelsBlack]
 def flip_policy(pol):
     global Unflipped_index
     return np.asarray([pol[ind] for ind in Unflipped_index])
+
+_label_index = {x: i for i, x in enumerate(ActionLabelsRed)}
+Mirrored_index = np.asarray([_label_index[mirror_move(x)] for x in ActionLabelsRed])
+
+def mirror_policy(pol):
+    '''
+    Policy of the mirrored position, Mirrored_index is its own inverse
+    '''
+    return np.asarray(pol)[..., Mirrored_index]
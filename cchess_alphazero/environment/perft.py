@@ -0,0 +1,237 @@
+'''
+Perft: number of leaf nodes of the move tree at a fixed depth, for the three rules implementations
+
+    static   static_env (array_board), used by the search
+    light    light_env.L_Chessboard
+    heavy    Chessboard and chessman.py, used by the GUI
+
+Move generation is pseudo-legal in all of them (a move may leave the own king in check),
+so the counts are not comparable with published Xiangqi perft results. A position is a leaf
+of the tree when a king has been captured or both kings face each other on an open file.
+'''
+import copy
+from logging import getLogger
+from time import time
+
+import cchess_alphazero.environment.array_board as ab
+import cchess_alphazero.environment.static_env as senv
+from cchess_alphazero.environment.chessboard import Chessboard
+from cchess_alphazero.environment.chessman import Rook, Knight, Cannon, Mandarin, Elephant, Pawn, King
+from cchess_alphazero.environment.light_env.chessboard import L_Chessboard
+from cchess_alphazero.environment.light_env.common import RED
+
+logger = getLogger(__name__)
+
+# (name, fen, node counts of static_env at depth 1, 2, 3), the counts are the regression baseline
+PERFT_POSITIONS = [
+    ('opening', 'rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w - - 0 1',
+     [44, 1926, 80288]),
+    ('central cannon', 'rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C2C4/9/RNBAKABNR b - - 0 1',
+     [45, 1566, 67026]),
+    ('middlegame', 'r1ba1a3/4kn3/2n1b4/pNp1p1p1p/4c4/6P2/P1P2R2P/1CcC5/9/2BAKAB2 w - - 0 1',
+     [44, 1329, 56972]),
+    ('endgame', '3k5/4a4/4ba3/4N4/2b6/9/9/4B4/4A4/3AK4 w - - 0 1',
+     [14, 112, 1590]),
+]
+
+BACKENDS = ['static', 'light', 'heavy']
+HEAVY_MAX_DEPTH = 2     # the heavy board is copied at every node
+
+def fen_to_perft_state(fen):
+    '''
+    State of the side to move, as used by static_env
+    '''
+    if fen.split(' ')[1] == 'b':
+        fen = senv.flip_fen(fen)
+    return senv.fen_to_state(fen)
+
+def _static_leaf(state):
+    board = ab.state_to_array(state)
+    red_k = board.find(ab.KING)
+    black_k = board.find(ab.KING | ab.OPPONENT)
+    if red_k < 0 or black_k < 0:
+        return True
+    if red_k % ab.ROW_STRIDE != black_k % ab.ROW_STRIDE:
+        return False
+    for sq in ab.RAYS[red_k][0]:
+        if sq == black_k:
+            return True
+        if board[sq] != ab.EMPTY:
+            return False
+
+def static_divide(state, depth):
+    '''
+    Node counts at depth below every move of the state, keyed by the move
+    '''
+    return {mov: static_perft(senv.step(state, mov), depth - 1) for mov in senv.get_legal_moves(state)}
+
+def static_perft(state, depth):
+    if depth == 0:
+        return 1
+    if _static_leaf(state):
+        return 0
+    moves = senv.get_legal_move_indexes(state)
+    if depth == 1:
+        return len(moves)
+    return sum(static_perft(senv.step(state, mov), depth - 1) for mov in moves)
+
+def light_board(state):
+    '''
+    L_Chessboard of the state, the side to move plays as RED
+    '''
+    board = L_Chessboard()
+    board.board = senv.state_to_board(state)
+    board.turn = RED
+    board.steps = 0
+    return board
+
+def _light_leaf(board):
+    kings = {}
+    for y in range(board.height):
+        for x in range(board.width):
+            if board.board[y][x] in 'kK':
+                kings[board.board[y][x]] = (x, y)
+    if len(kings) < 2:
+        return True
+    (x0, y0), (x1, y1) = sorted(kings.values(), key=lambda p: p[1])
+    if x0 != x1:
+        return False
+    return all(board.board[y][x0] == '.' for y in range(y0 + 1, y1))
+
+def _light_push(board, mov):
+    x0, y0, x1, y1 = int(mov[0]), int(mov[1]), int(mov[2]), int(mov[3])
+    captured = board.board[y1][x1]
+    board.board[y1][x1] = board.board[y0][x0]
+    board.board[y0][x0] = '.'
+    board._update()
+    return captured
+
+def _light_pop(board, mov, captured):
+    x0, y0, x1, y1 = int(mov[0]), int(mov[1]), int(mov[2]), int(mov[3])
+    board.board[y0][x0] = board.board[y1][x1]
+    board.board[y1][x1] = captured
+    board.steps -= 2
+    board._update()
+
+def light_divide(board, depth):
+    result = {}
+    for mov in list(board.legal_moves()):
+        captured = _light_push(board, mov)
+        result[mov] = light_perft(board, depth - 1)
+        _light_pop(board, mov, captured)
+    return result
+
+def light_perft(board, depth):
+    if depth == 0:
+        return 1
+    if _light_leaf(board):
+        return 0
+    moves = list(board.legal_moves())
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for mov in moves:
+        captured = _light_push(board, mov)
+        nodes += light_perft(board, depth - 1)
+        _light_pop(board, mov, captured)
+    return nodes
+
+_HEAVY_PIECES = {'r': Rook, 'k': Knight, 'c': Cannon, 'm': Mandarin, 'e': Elephant, 'p': Pawn, 's': King}
+
+def heavy_board(state):
+    '''
+    Chessboard of the state, the side to move plays as red
+    '''
+    board = Chessboard()
+    count = 0
+    # row 0 of the state is the opponent's back rank
+    for i, ch in enumerate(state.translate(senv._EXPAND_FEN)):
+        if ch == '.':
+            continue
+        x, y = i % 9, 9 - i // 9
+        is_red = ch.isupper()
+        if ch.lower() == 's':
+            name = 'red_king' if is_red else 'black_king'
+        else:
+            count += 1
+            name = f"{'red' if is_red else 'black'}_{ch.lower()}_{count}"
+        _HEAVY_PIECES[ch.lower()](name, name, is_red, board, ch).add_to_board(x, y)
+    board.calc_chessmans_moving_list()
+    return board
+
+def _heavy_leaf(board):
+    red_king = board.get_chessman_by_name('red_king')
+    black_king = board.get_chessman_by_name('black_king')
+    if not red_king or not black_king:
+        return True
+    x = red_king.position.x
+    if x != black_king.position.x:
+        return False
+    return all(board.chessmans[x][y] is None for y in range(red_king.position.y + 1, black_king.position.y))
+
+def _heavy_child(board, mov):
+    child = copy.deepcopy(board)
+    child.move_action_str(mov)
+    child.calc_chessmans_moving_list()
+    return child
+
+def heavy_divide(board, depth):
+    return {mov: heavy_perft(_heavy_child(board, mov), depth - 1) for mov in board.legal_moves()}
+
+def heavy_perft(board, depth):
+    if depth == 0:
+        return 1
+    if _heavy_leaf(board):
+        return 0
+    moves = board.legal_moves()
+    if depth == 1:
+        return len(moves)
+    return sum(heavy_perft(_heavy_child(board, mov), depth - 1) for mov in moves)
+
+def backend_root(backend, state):
+    if backend == 'static':
+        return state, static_perft, static_divide
+    elif backend == 'light':
+        return light_board(state), light_perft, light_divide
+    else:
+        return heavy_board(state), heavy_perft, heavy_divide
+
+def run(max_depth=3, backends=None, positions=None):
+    '''
+    Count the nodes of every position with every backend up to max_depth, report nodes/sec
+    and the moves whose subtrees differ when a backend disagrees with the baseline
+
+    :return: number of mismatches
+    '''
+    backends = backends or BACKENDS
+    positions = positions or PERFT_POSITIONS
+    mismatches = 0
+    for name, fen, expected in positions:
+        state = fen_to_perft_state(fen)
+        for depth in range(1, max_depth + 1):
+            baseline = expected[depth - 1] if depth <= len(expected) else None
+            for backend in backends:
+                if backend == 'heavy' and depth > HEAVY_MAX_DEPTH:
+                    continue
+                root, perft, divide = backend_root(backend, state)
+                start = time()
+                nodes = perft(root, depth)
+                cost = max(time() - start, 1e-9)
+                if baseline is None and backend == 'static':
+                    baseline = nodes
+                ok = baseline is None or nodes == baseline
+                logger.info(f"perft {name} depth {depth} {backend:6s}: {nodes:8d} nodes, "
+                            f"{nodes / cost:9.0f} nodes/sec {'' if ok else f'MISMATCH, expected {baseline}'}")
+                if not ok:
+                    mismatches += 1
+                    if depth > 1:
+                        reference = static_divide(state, depth)
+                        counts = divide(backend_root(backend, state)[0], depth)
+                        for mov in sorted(set(reference) | set(counts)):
+                            if reference.get(mov) != counts.get(mov):
+                                logger.info(f"  {mov}: static {reference.get(mov)}, {backend} {counts.get(mov)}")
+    logger.info(f"perft done, {mismatches} mismatches")
+    return mismatches
+
+def start(config, max_depth=3):
+    return run(max_depth)
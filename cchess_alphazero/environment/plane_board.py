@@ -0,0 +1,71 @@
+'''
+Input planes of a position updated incrementally along a search path
+
+The planes are kept in the orientation of the side to move at the root of the search.
+A move of either side clears its source square, clears the captured piece and sets the destination,
+the perspective of the side to move is applied only when the planes are encoded, as an index permutation:
+flipping the side reverses rows and columns (square ``i -> 89 - i``) and swaps the upper and lower planes.
+'''
+import numpy as np
+
+import cchess_alphazero.environment.array_board as ab
+import cchess_alphazero.environment.static_env as senv
+
+PLANE_DEPTH = 14
+SWAP_SIDE_PLANES = np.r_[7:14, 0:7]
+
+# label index -> source and destination square in 0 ~ 89, row major in the state string order
+MOVE_FROM_INDEX = [sq - sq // ab.ROW_STRIDE for sq in ab.MOVE_FROM]
+MOVE_TO_INDEX = [sq - sq // ab.ROW_STRIDE for sq in ab.MOVE_TO]
+
+class PlaneBoard:
+    '''
+    :param state: state string of the root, None to create an empty board for copy()
+    '''
+    __slots__ = ('planes', 'squares', 'flipped')
+
+    def __init__(self, state=None):
+        if state is None:
+            return
+        planes = senv.states_to_planes([state], dtype=np.uint8)[0]
+        self.planes = planes.reshape(senv.BOARD_HEIGHT * senv.BOARD_WIDTH, PLANE_DEPTH)   # (square, plane)
+        occupied = self.planes.any(axis=1)
+        self.squares = bytearray(np.where(occupied, self.planes.argmax(axis=1), senv.NO_PLANE).astype(np.uint8))
+        self.flipped = False                # whether the side to move is the opponent of the root
+
+    def copy(self):
+        board = PlaneBoard()
+        board.planes = self.planes.copy()
+        board.squares = bytearray(self.squares)
+        board.flipped = self.flipped
+        return board
+
+    def move(self, action):
+        '''
+        Make a move given as ActionLabelsRed index, in the view of the side to move
+        '''
+        src, dst = MOVE_FROM_INDEX[action], MOVE_TO_INDEX[action]
+        if self.flipped:
+            src, dst = 89 - src, 89 - dst
+        squares = self.squares
+        piece, captured = squares[src], squares[dst]
+        planes = self.planes
+        planes[src, piece] = 0
+        if captured != senv.NO_PLANE:
+            planes[dst, captured] = 0
+        planes[dst, piece] = 1
+        squares[dst] = piece
+        squares[src] = senv.NO_PLANE
+        self.flipped = not self.flipped
+
+    def encode(self, out, mirror=False):
+        '''
+        Write the planes of the side to move into out of shape (10, 9, 14), mirrored left-right if mirror
+        '''
+        planes = self.planes.reshape(senv.BOARD_HEIGHT, senv.BOARD_WIDTH, PLANE_DEPTH)
+        if self.flipped:
+            planes = planes[::-1, ::-1, SWAP_SIDE_PLANES]
+        if mirror:
+            planes = planes[:, ::-1]
+        out[...] = planes
+        return out
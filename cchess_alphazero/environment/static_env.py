@@ -1,7 +1,8 @@
 import numpy as np
 
 from cchess_alphazero.environment.light_env.common import *
-from cchess_alphazero.environment.lookup_tables import Winner, Fen_2_Idx, flip_move
+from cchess_alphazero.environment.lookup_tables import Winner, Fen_2_Idx, ActionLabelsRed
+import cchess_alphazero.environment.array_board as ab
 from logging import getLogger
 
 logger = getLogger(__name__)
@@ -11,6 +12,19 @@ INIT_STATE = 'rkemsmekr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RKEMSMEKR'
 BOARD_HEIGHT = 10
 BOARD_WIDTH = 9
 
+# FEN rows expanded to one char per square, for the batch plane encoder
+_EXPAND_FEN = str.maketrans(dict([(str(i), '.' * i) for i in range(1, 10)] + [('/', None)]))
+# plane of each piece letter, 0 ~ 7 : upper, 7 ~ 14: lower, NO_PLANE for empty squares
+NO_PLANE = 255
+PLANE_INDEX = np.full(256, NO_PLANE, dtype=np.uint8)
+for _letter, _idx in Fen_2_Idx.items():
+    PLANE_INDEX[ord(_letter)] = _idx + int(_letter.islower()) * 7
+
+# repetition adjudication: (Zobrist key, action) -> will_check_or_catch, Zobrist key -> catches
+REPETITION_CACHE_SIZE = 100000
+_check_or_catch_cache = {}
+_catch_cache = {}
+
 def done(state, turns=-1, need_check=False):
     if 's' not in state:
         return (True, 1, None)
@@ -18,84 +32,67 @@ def done(state, turns=-1, need_check=False):
         return (True, -1, None)
     # if turns > 0 and turns < 20:
     #     return (False, 0, None)
-    board = state_to_board(state)
-    red_k, black_k = [0, 0], [0, 0]
+    board = ab.state_to_array(state)
+    red_k = board.find(ab.KING)
+    black_k = board.find(ab.KING | ab.OPPONENT)
     winner = None
     v = 0
-    for i in range(BOARD_HEIGHT):
-        for j in range(BOARD_WIDTH):
-            if board[i][j] == 'k':
-                red_k[0] = i
-                red_k[1] = j
-            if board[i][j] == 'K':
-                black_k[0] = i
-                black_k[1] = j
-    if red_k[0] == 0 and red_k[1] == 0:
+    if red_k < 0:
         winner = Winner.black
         v = -1
-    elif black_k[0] == 0 and black_k[1] == 0:
+    elif black_k < 0:
         winner = Winner.red
         v = 1
-    elif red_k[1] == black_k[1]:
+    elif red_k % ab.ROW_STRIDE == black_k % ab.ROW_STRIDE:
         has_block = False
-        i = red_k[0] + 1
-        while i < black_k[0]:
-            if board[i][red_k[1]] != '.':
+        for sq in ab.RAYS[red_k][0]:
+            if sq == black_k:
+                break
+            if board[sq] != ab.EMPTY:
                 has_block = True
                 break
-            i += 1
         if not has_block:
             v = 1
             winner = Winner.red
     final_move = None
     check = False
     if winner is None:
-        legal_moves = get_legal_moves(state, board)
-        for mov in legal_moves:
-            dest = [int(mov[3]), int(mov[2])]
-            if dest == black_k:
-                winner = Winner.red
-                v = 1
-                final_move = mov
-                break
+        # a piece can capture the opponent king
+        src = ab.attacker(board, black_k)
+        if src >= 0:
+            winner = Winner.red
+            v = 1
+            final_move = ActionLabelsRed[ab.MOVE_INDEX[src][black_k]]
     if winner is None and need_check:
-        black_state = fliped_state(state)
-        black_moves = get_legal_moves(black_state)
-        # render(black_state)
-        red_k[0] = 9 - red_k[0]
-        red_k[1] = 8 - red_k[1]
-        for mov in black_moves:
-            dest = [int(mov[3]), int(mov[2])]
-            if dest == red_k:
-                check = True
-                # logger.debug(f"Checking move {mov}")
-                break
-        # logger.debug(f"red_k = {red_k}, black_moves = {black_moves}, check = {check}")
+        # the opponent can capture the king, seen from its side
+        check = ab.attacker(ab.flip_array(board), ab.ARRAY_SIZE - 1 - red_k) >= 0
     if need_check:
         return (winner is not None, v, final_move, check)
     else:
         return (winner is not None, v, final_move)
 
-def step(state, action):
-    board = state_to_board(state)
-    if board[int(action[1])][int(action[0])] == '.':
-        raise ValueError(f"No chessman in {action}, state = {state}")
-    board[int(action[3])][int(action[2])] = board[int(action[1])][int(action[0])]
-    board[int(action[1])][int(action[0])] = '.'
-    state = board_to_state(board)
-    return fliped_state(state)
-
-def new_step(state, action):
-    no_eat = True
-    board = state_to_board(state)
-    if board[int(action[1])][int(action[0])] == '.':
-        raise ValueError(f"No chessman in {action}, state = {state}")
-    if board[int(action[3])][int(action[2])] != '.':
-        no_eat = False
-    board[int(action[3])][int(action[2])] = board[int(action[1])][int(action[0])]
-    board[int(action[1])][int(action[0])] = '.'
-    state = board_to_state(board)
-    return fliped_state(state), no_eat
+def step(state, action, key=None):
+    '''
+    If the Zobrist key of state is given, return (next state, next key)
+    '''
+    next_state, _, next_key = ab.apply_move(state, action, key)
+    if key is None:
+        return next_state
+    else:
+        return next_state, next_key
+
+def new_step(state, action, key=None):
+    next_state, captured, next_key = ab.apply_move(state, action, key)
+    if key is None:
+        return next_state, not captured
+    else:
+        return next_state, not captured, next_key
+
+def state_key(state):
+    '''
+    64-bit Zobrist key of the state, see array_board
+    '''
+    return ab.state_key(state)
 
 def evaluate(state):
     piece_vals = {'R': 14, 'K': 7, 'E': 3, 'M': 2, 'S':1, 'C': 5, 'P': 1} # for RED account
@@ -155,19 +152,7 @@ def state_to_planes(state, data_format="channels_last"):
                 else:
                     j += int(letter)
     else:  # channels_last
-        planes = np.zeros(shape=(10, 9, 14), dtype=np.float32)
-        rows = state.split('/')
-
-        for i in range(len(rows)):
-            row = rows[i]
-            j = 0
-            for letter in row:
-                if letter.isalpha():
-                    # 0 ~ 7 : upper, 7 ~ 14: lower
-                    planes[i][j][Fen_2_Idx[letter] + int(letter.islower()) * 7] = 1
-                    j += 1
-                else:
-                    j += int(letter)
+        planes = states_to_planes([state])[0]
     return planes
 
 def state_history_to_planes(state, history, data_format="channels_last"):
@@ -208,37 +193,52 @@ def state_history_to_planes(state, history, data_format="channels_last"):
                     else:
                         j += int(letter)
     else:  # channels_last
-        planes = np.zeros(shape=(10, 9, 28), dtype=np.float32)
-        rows = state.split('/')
-        # 0 ~ 14 for current state
-        for i in range(len(rows)):
-            row = rows[i]
-            j = 0
-            for letter in row:
-                if letter.isalpha():
-                    # 0 ~ 7 : upper, 7 ~ 14: lower
-                    planes[i][j][Fen_2_Idx[letter] + int(letter.islower()) * 7] = 1
-                    j += 1
-                else:
-                    j += int(letter)
-        # 14 ~ 28 for last state
-        # history = [...,last state, red action, black state, black action, current state]
-        if history and len(history) >= 5:
-            last_state = history[-5]
-            # logger.debug(f"last state = {last_state}")
-            rows = last_state.split('/')
-            for i in range(len(rows)):
-                row = rows[i]
-                j = 0
-                for letter in row:
-                    if letter.isalpha():
-                        # 0 ~ 7 : upper, 7 ~ 14: lower
-                        planes[i][j][Fen_2_Idx[letter] + int(letter.islower()) * 7 + 14] = 1
-                        j += 1
-                    else:
-                        j += int(letter)
+        last_state = history[-5] if history and len(history) >= 5 else None
+        planes = states_to_planes([state], [last_state])[0]
     return planes
 
+def _square_planes(states):
+    '''
+    Plane index of the 90 squares of each state, NO_PLANE for empty squares
+    '''
+    board = ''.join(state.translate(_EXPAND_FEN) for state in states).encode('ascii')
+    return PLANE_INDEX[np.frombuffer(board, dtype=np.uint8)].reshape(len(states), BOARD_HEIGHT * BOARD_WIDTH)
+
+def states_to_planes(states, last_states=None, out=None, dtype=np.float32):
+    '''
+    Batch encoder of states into channels_last planes of shape (n, 10, 9, 14),
+    or (n, 10, 9, 28) with last_states, the same as state_to_planes and state_history_to_planes
+
+    :param last_states: state two plies before each state (history[-5]) or None, for the history planes
+    :param out: C contiguous array to write into, e.g. rows of the shared memory inference slab
+    '''
+    n = len(states)
+    depth = 14 if last_states is None else 28
+    if out is None:
+        out = np.zeros((n, BOARD_HEIGHT, BOARD_WIDTH, depth), dtype=dtype)
+    else:
+        if not out.flags.c_contiguous or out.shape != (n, BOARD_HEIGHT, BOARD_WIDTH, depth):
+            raise ValueError(f"out must be a contiguous array of shape {(n, BOARD_HEIGHT, BOARD_WIDTH, depth)}")
+        out[...] = 0
+    flat = out.reshape(n, -1)
+    squares = _square_planes(states)
+    rows, cols = np.nonzero(squares != NO_PLANE)
+    flat[rows, cols * depth + squares[rows, cols]] = 1
+    if last_states is not None:
+        idx = np.array([i for i, last in enumerate(last_states) if last is not None], dtype=np.intp)
+        if len(idx):
+            squares = _square_planes([last_states[i] for i in idx])
+            rows, cols = np.nonzero(squares != NO_PLANE)
+            flat[idx[rows], cols * depth + squares[rows, cols] + 14] = 1
+    return out
+
+def states_to_packed_planes(states, last_states=None):
+    '''
+    Bit packed planes of states, rows of (10 * 9 * depth + 7) // 8 bytes
+    '''
+    planes = states_to_planes(states, last_states, dtype=np.uint8)
+    return np.packbits(planes.reshape(len(states), -1), axis=1)
+
 def board_to_state(board):
     c = 0
     fen = ''
@@ -288,6 +288,23 @@ def flip_fen(fen):
         + " " + foo[2] \
         + " " + foo[3] + " " + foo[4] + " " + foo[5]
 
+def mirror_state(state):
+    '''
+    Mirror the state along the middle file (left <-> right)
+    '''
+    return '/'.join([row[::-1] for row in state.split('/')])
+
+def canonical_state(state):
+    '''
+    The smaller one of the state and its mirror, used to share NN evaluations of mirrored positions
+
+    :return: (canonical state, whether it is mirrored)
+    '''
+    mirror = mirror_state(state)
+    if mirror < state:
+        return mirror, True
+    return state, False
+
 def fliped_state(state):
     rows = state.split('/')
     def swapcase(a):
@@ -300,7 +317,18 @@ def fliped_state(state):
     return "/".join([swapall(reversed(row)) for row in reversed(rows)])
 
 def get_legal_moves(state, board=None):
-    board = board if board is not None else state_to_board(state)
+    return [ActionLabelsRed[mov] for mov in ab.legal_moves(state)]
+
+def get_legal_move_indexes(state):
+    '''
+    Legal moves as indexes of ActionLabelsRed
+    '''
+    return ab.legal_moves(state)
+
+def get_board_legal_moves(board):
+    '''
+    Reference move generator on the list-of-lists board, kept for cross-checking array_board
+    '''
     legal_moves = []
     for y in range(BOARD_HEIGHT):
         for x in range(BOARD_WIDTH):
@@ -433,86 +461,61 @@ def to_uci_move(action):
     move = x0 + action[1] + x1 + action[3]
     return move
 
-def will_check_or_catch(ori_state, action):
+def will_check_or_catch(ori_state, action, key=None):
     '''
     判断走了下一步是否会造成红方将军或捉子
+    The result is cached by (Zobrist key, action), pass the key of ori_state if known.
     '''
-    state = step(ori_state, action)     # 判断当前state的红方是否会被将/捉
-    board = state_to_board(state)
-    # permanent check
-    red_k = [0, 0]
-    for i in range(BOARD_HEIGHT):
-        for j in range(BOARD_WIDTH):
-            if board[i][j] == 'k':
-                red_k[0] = i
-                red_k[1] = j
-    black_state = fliped_state(state)
-    black_moves = get_legal_moves(black_state)
-    # render(black_state)
-    red_k[0] = 9 - red_k[0]
-    red_k[1] = 8 - red_k[1]
-    for mov in black_moves:
-        dest = [int(mov[3]), int(mov[2])]
-        if dest == red_k:
-            check = True
-            # logger.debug(f"Checking move {mov}")
-            return True
-    # permanent catch
-    first_set = get_catch_list(ori_state)
-    second_set = get_catch_list(black_state, black_moves)
-    if second_set - first_set != set() and len(second_set) >= len(first_set):
-        # logger.debug(f"Permanent catch, first_set = {first_set}, second_set = {second_set}")
-        return True
-    else:
-        return False
-
-def get_catch_list(state, moves=None):
-    catch_list = set()
-    if not moves:
-        moves = get_legal_moves(state)
-    for mov in moves:
-        next_state, no_eat = new_step(state, mov)
-        if not no_eat:  # 有吃子
-            # 判断能不能吃回来(防御)
-            could_defend = False
-            next_moves = get_legal_moves(next_state)
-            fliped_move = flip_move(mov)
-            dest = fliped_move[2:]
-            for nmov in next_moves:
-                if nmov[2:] == dest:
-                    could_defend = True
-                    break
-            if not could_defend:
-                i = int(mov[1])
-                j = int(mov[0])
-                black_board = state_to_board(state)
-                if black_board[i][j] == 'p' and i <= 4:
-                    continue
-                m = int(mov[3])
-                n = int(mov[2])
-                if black_board[m][n] == 'P' and m > 4:
-                    continue
-                # 判断是否为兑
-                if black_board[m][n].upper() == black_board[i][j].upper():
-                    continue
-                # print(f"Catch: mov = {mov}, chessman = {black_board[i][j]}")
-                catch_list.add((black_board[i][j], i, j, black_board[m][n], m, n))
-    return catch_list
+    board = None
+    if key is None:
+        board = ab.state_to_array(ori_state)
+        key = ab.array_key(board)
+    cache_key = (key, action)
+    result = _check_or_catch_cache.get(cache_key)
+    if result is None:
+        if board is None:
+            board = ab.state_to_array(ori_state)
+        src, dst = ab.move_squares(action)
+        after = ab.make_move(board, src, dst)
+        # permanent check
+        red_k = after.find(ab.KING | ab.OPPONENT)
+        result = red_k >= 0 and ab.attacker(after, red_k) >= 0
+        if not result:
+            # permanent catch
+            first_set = _cached_catches(key, board)
+            second_set = ab.catches(after)
+            result = second_set - first_set != set() and len(second_set) >= len(first_set)
+        _cache_put(_check_or_catch_cache, cache_key, result)
+    return result
+
+def get_catch_list(state, key=None):
+    '''
+    Catches of the side to move, see array_board.catches
+    '''
+    board = ab.state_to_array(state)
+    if key is None:
+        key = ab.array_key(board)
+    return _cached_catches(key, board)
 
 def be_catched(state, mov):
-    i = int(mov[1])
-    j = int(mov[0])
-    position = [i, j]
-    board = state_to_board(state)
-    black_state = fliped_state(state)
-    black_moves = get_legal_moves(black_state)
-    position[0] = 9 - position[0]
-    position[1] = 8 - position[1]
-    for mov in black_moves:
-        dest = [int(mov[3]), int(mov[2])]
-        if dest == position:
-            return True
-    return False
+    '''
+    Whether the opponent can capture the piece which makes the move mov
+    '''
+    src, _ = ab.move_squares(mov)
+    board = ab.flip_array(ab.state_to_array(state))
+    return ab.attacker(board, ab.ARRAY_SIZE - 1 - src) >= 0
+
+def _cached_catches(key, board):
+    catches = _catch_cache.get(key)
+    if catches is None:
+        catches = ab.catches(board)
+        _cache_put(_catch_cache, key, catches)
+    return catches
+
+def _cache_put(cache, key, value):
+    if len(cache) >= REPETITION_CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
 
 def has_attack_chessman(state):
     '''
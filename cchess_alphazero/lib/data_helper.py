@@ -1,17 +1,53 @@
+'''
+Binary play data format (little endian), the games of a file are stored column by column:
+
+    header          magic b'CCPD', version u8, plane depth u8 (0 = no planes), flags u16,
+                    number of games u32, number of moves u32
+    offsets         uint32[games + 1], first move of every game in the move columns
+    init states     games x 100 bytes, ascii padded with \\0
+    moves           uint16[moves], index of the move in ActionLabelsRed
+    values          int8[moves], value of the position before the move, times VALUE_SCALE
+    samples         uint8[moves], 0 if the position is not a training sample (only with FLAG_SAMPLES)
+    planes          uint8[moves, plane_bytes(depth)], bit packed planes of the positions (optional)
+
+In json play data a move which is not a training sample, e.g. played after a cheap search,
+is stored as [move, value, 0] instead of [move, value].
+'''
 import os
 import json
+import struct
 from datetime import datetime
 from glob import glob
 from logging import getLogger
 
+import numpy as np
+
+import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.config import ResourceConfig
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed
 
 logger = getLogger(__name__)
 
+BINARY_MAGIC = b'CCPD'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sBBHII')
+STATE_BYTES = 100           # 10 rows of at most 9 chars and 9 separators
+FLAG_SAMPLES = 1            # the file has a samples column
+VALUE_SCALE = 127
+BOARD_SHAPE = (10, 9)
+JSON_BYTES_PER_MOVE = 14     # approximate size of a [move, value] item in json play data
+MOVE_INDEX = {move: i for i, move in enumerate(ActionLabelsRed)}
+
+def plane_bytes(depth):
+    return (BOARD_SHAPE[0] * BOARD_SHAPE[1] * depth + 7) // 8
+
 def get_game_data_filenames(rc: ResourceConfig):
-    pattern = os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % "*")
+    files = []
+    for tmpl in (rc.play_data_filename_tmpl, rc.play_data_binary_filename_tmpl):
+        pattern = os.path.join(rc.play_data_dir, tmpl % "*")
+        files += glob(pattern)
     # files = list(sorted(glob(pattern), key=get_key))
-    files = list(sorted(glob(pattern)))
+    files = list(sorted(files))
     return files
 
 def write_game_data_to_file(path, data):
@@ -20,9 +56,235 @@ def write_game_data_to_file(path, data):
 
 
 def read_game_data_from_file(path):
+    if is_binary_game_data(path):
+        data = []
+        for game in read_binary_game_data(path).games():
+            data += game
+        return data
     with open(path, "rt") as f:
         return json.load(f)
 
 def get_key(x):
-    stat_x = os.stat(x) 
+    stat_x = os.stat(x)
     return stat_x.st_ctime
+
+def is_binary_game_data(path):
+    return path.endswith('.bin')
+
+def count_positions(path):
+    '''
+    Number of positions of a play data file without decoding it, estimated from the size for json files
+    '''
+    if is_binary_game_data(path):
+        with open(path, "rb") as f:
+            return BINARY_HEADER.unpack(f.read(BINARY_HEADER.size))[5]
+    return os.path.getsize(path) // JSON_BYTES_PER_MOVE
+
+def split_game_data(data):
+    '''
+    Split the content of a json play data file, which may hold several games one after another,
+    into a list of games [init state, [move, value], ...]
+    '''
+    games = []
+    for item in data:
+        if isinstance(item, str):
+            games.append([item])
+        elif games:
+            games[-1].append(item)
+    return games
+
+def game_states(init_state, moves, use_history=False):
+    '''
+    States before each move of a game replayed from its initial state,
+    and the states two plies before them (None for the first two) if use_history
+    '''
+    states = [init_state]
+    for move in moves[:-1]:
+        states.append(senv.step(states[-1], move))
+    last_states = [None, None][:len(states)] + states[:-2] if use_history else None
+    return states, last_states
+
+def game_planes(init_state, moves, use_history=False):
+    '''
+    Planes of the positions before each move of a game, replayed from its initial state
+    '''
+    return senv.states_to_planes(*game_states(init_state, moves, use_history))
+
+def pack_planes(planes):
+    '''
+    Bit pack planes of shape (n, 10, 9, depth) into (n, plane_bytes(depth)) uint8
+    '''
+    return np.packbits(planes.reshape(len(planes), -1).astype(np.bool_), axis=1)
+
+def unpack_planes(packed, depth):
+    '''
+    Planes of shape (n, 10, 9, depth) as float32 from their bit packed rows
+    '''
+    shape = BOARD_SHAPE + (depth, )
+    bits = np.unpackbits(packed, axis=1, count=int(np.prod(shape)))
+    return bits.reshape((len(packed), ) + shape).astype(np.float32)
+
+def is_sample(item):
+    '''
+    Whether a [move, value] item of json play data is a training sample
+    '''
+    return len(item) < 3 or bool(item[2])
+
+def pack_game_data(games, with_planes=False, use_history=False):
+    '''
+    Columns of games [init state, [move, value], ...]
+
+    :param with_planes: also compute the bit packed planes of every position
+    '''
+    states = np.zeros(len(games), dtype='S%d' % STATE_BYTES)
+    offsets = np.zeros(len(games) + 1, dtype=np.uint32)
+    moves, values, samples = [], [], []
+    for i, game in enumerate(games):
+        states[i] = game[0].encode('ascii')
+        moves += [MOVE_INDEX[item[0]] for item in game[1:]]
+        values += [item[1] for item in game[1:]]
+        samples += [is_sample(item) for item in game[1:]]
+        offsets[i + 1] = len(moves)
+    moves = np.asarray(moves, dtype=np.uint16)
+    values = np.rint(np.asarray(values, dtype=np.float32) * VALUE_SCALE).astype(np.int8)
+    samples = None if all(samples) else np.asarray(samples, dtype=np.uint8)
+    columns = PlayDataColumns(states, offsets, moves, values, samples=samples)
+    if with_planes:
+        columns.planes = columns.packed_planes(use_history)
+        columns.plane_depth = 28 if use_history else 14
+    return columns
+
+def write_binary_game_data(path, games, with_planes=False, use_history=False):
+    '''
+    Write games [init state, [move, value], ...] in the binary format
+
+    :param with_planes: also store the bit packed planes, so the optimizer does not replay the games
+    '''
+    columns = pack_game_data(games, with_planes, use_history)
+    flags = FLAG_SAMPLES if columns.samples is not None else 0
+    with open(path, "wb") as f:
+        f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, columns.plane_depth, flags,
+                                   len(columns.states), len(columns)))
+        for column in (columns.offsets, columns.states, columns.moves, columns.values):
+            f.write(column.tobytes())
+        if columns.samples is not None:
+            f.write(columns.samples.tobytes())
+        if columns.planes is not None:
+            f.write(columns.planes.tobytes())
+
+def read_binary_game_data(path):
+    '''
+    Read a binary play data file with a single read, the columns are views of its content
+    '''
+    with open(path, "rb") as f:
+        buf = f.read()
+    magic, version, depth, flags, n_games, n_moves = BINARY_HEADER.unpack_from(buf)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"{path} is not a play data file of version {BINARY_VERSION}")
+    offset = BINARY_HEADER.size
+    offsets = np.frombuffer(buf, dtype=np.uint32, count=n_games + 1, offset=offset)
+    offset += offsets.nbytes
+    states = np.frombuffer(buf, dtype='S%d' % STATE_BYTES, count=n_games, offset=offset)
+    offset += states.nbytes
+    moves = np.frombuffer(buf, dtype=np.uint16, count=n_moves, offset=offset)
+    offset += moves.nbytes
+    values = np.frombuffer(buf, dtype=np.int8, count=n_moves, offset=offset)
+    offset += values.nbytes
+    samples = None
+    if flags & FLAG_SAMPLES:
+        samples = np.frombuffer(buf, dtype=np.uint8, count=n_moves, offset=offset)
+        offset += samples.nbytes
+    planes = None
+    if depth:
+        planes = np.frombuffer(buf, dtype=np.uint8, count=n_moves * plane_bytes(depth), offset=offset)
+        planes = planes.reshape(n_moves, plane_bytes(depth))
+    return PlayDataColumns(states, offsets, moves, values, planes, depth, samples)
+
+class PlayDataColumns:
+    '''
+    Content of a binary play data file
+    '''
+    def __init__(self, states, offsets, moves, values, planes=None, plane_depth=0, samples=None):
+        self.states = states            # bytes, initial state of every game
+        self.offsets = offsets          # first move of every game, and the total number of moves
+        self.moves = moves              # index in ActionLabelsRed
+        self.values = values            # int8, times VALUE_SCALE
+        self.planes = planes            # bit packed planes or None
+        self.plane_depth = plane_depth
+        self.samples = samples          # uint8, 0 for positions which are not training samples, None if all are
+
+    def __len__(self):
+        return len(self.moves)
+
+    def value_array(self):
+        return self.values.astype(np.float32) / VALUE_SCALE
+
+    def sample_mask(self):
+        '''
+        Boolean mask of the training samples among all positions, None if all positions are samples
+        '''
+        return None if self.samples is None else self.samples.astype(np.bool_)
+
+    def packed_planes(self, use_history=False):
+        '''
+        Bit packed planes of all positions, the games are replayed if the stored planes do not match
+        '''
+        depth = 28 if use_history else 14
+        if self.planes is not None and self.plane_depth == depth:
+            return self.planes
+        packed = np.zeros((len(self), plane_bytes(depth)), dtype=np.uint8)
+        for i, state in enumerate(self.states):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            if start < end:
+                moves = [ActionLabelsRed[k] for k in self.moves[start:end]]
+                packed[start:end] = senv.states_to_packed_planes(*game_states(state.decode('ascii'), moves, use_history))
+        return packed
+
+    def unpack_planes(self, use_history=False):
+        '''
+        Planes of all positions as float32 of shape (moves, 10, 9, depth)
+        '''
+        return unpack_planes(self.packed_planes(use_history), 28 if use_history else 14)
+
+    def games(self):
+        '''
+        Games in the json format [init state, [move, value], ...]
+        '''
+        values = self.value_array().tolist()
+        for i, state in enumerate(self.states):
+            game = [state.decode('ascii')]
+            for k in range(self.offsets[i], self.offsets[i + 1]):
+                if self.samples is None or self.samples[k]:
+                    game.append([ActionLabelsRed[self.moves[k]], values[k]])
+                else:
+                    game.append([ActionLabelsRed[self.moves[k]], values[k], 0])
+            yield game
+
+def convert_play_data_file(path, with_planes=False, use_history=False, remove=True):
+    '''
+    Convert a json play data file into the binary format next to it
+
+    :return: path of the binary file
+    '''
+    data = read_game_data_from_file(path)
+    bin_path = os.path.splitext(path)[0] + '.bin'
+    write_binary_game_data(bin_path, split_game_data(data), with_planes, use_history)
+    if remove:
+        os.remove(path)
+    return bin_path
+
+def convert_play_data(rc: ResourceConfig, with_planes=False, use_history=False, remove=True):
+    '''
+    Convert all json play data files into the binary format
+    '''
+    pattern = os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % "*")
+    files = list(sorted(glob(pattern)))
+    cnt = 0
+    for path in files:
+        try:
+            convert_play_data_file(path, with_planes, use_history, remove)
+            cnt += 1
+        except Exception as e:
+            logger.error(f"Convert {path} error: {e}")
+    logger.info(f"Converted {cnt}/{len(files)} play data files to binary format")
+    return cnt
@@ -0,0 +1,176 @@
+'''
+Buffers of training positions: a memory mapped replay ring and a shuffle buffer for streaming
+
+Positions are kept on disk as bit packed planes, the index of the played move as sparse policy target
+and the value, so the memory used by the optimizer does not depend on the size of the window.
+The buffer survives restarts of the optimizer, its head and size are saved in meta.json.
+'''
+import os
+import json
+from logging import getLogger
+
+import numpy as np
+
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, Mirrored_index
+from cchess_alphazero.lib.data_helper import plane_bytes, unpack_planes
+
+logger = getLogger(__name__)
+
+def training_data(planes, moves, values, plane_depth, mirror=None):
+    '''
+    Dense training data from bit packed planes and move indexes
+
+    :param mirror: boolean mask of the positions to mirror left-right
+    :return: (planes of shape (n, 10, 9, depth), dense policy of shape (n, labels), values)
+    '''
+    state_ary = unpack_planes(planes, plane_depth)
+    moves = moves.astype(np.intp)
+    if mirror is not None and mirror.any():
+        state_ary[mirror] = state_ary[mirror][:, :, ::-1, :]
+        moves[mirror] = Mirrored_index[moves[mirror]]
+    policy_ary = np.zeros((len(moves), len(ActionLabelsRed)), dtype=np.float32)
+    policy_ary[np.arange(len(moves)), moves] = 1
+    return state_ary, policy_ary, np.asarray(values, dtype=np.float32)
+
+class ReplayBuffer:
+    '''
+    :param path: directory of the buffer files
+    :param capacity: number of positions, the oldest ones are overwritten when the buffer is full
+    :param plane_depth: 14, or 28 with history planes
+    '''
+    def __init__(self, path, capacity, plane_depth=14):
+        self.path = path
+        self.capacity = capacity
+        self.plane_depth = plane_depth
+        self.meta_path = os.path.join(path, 'meta.json')
+        self.head = 0           # next row to write
+        self.size = 0
+        os.makedirs(path, exist_ok=True)
+        mode = 'w+'
+        meta = self.load_meta()
+        if meta is not None and meta['capacity'] == capacity and meta['plane_depth'] == plane_depth:
+            self.head, self.size = meta['head'], meta['size']
+            mode = 'r+'
+            logger.info(f"Load replay buffer {path} with {self.size} positions")
+        self.planes = self.open('planes.dat', np.uint8, (capacity, plane_bytes(plane_depth)), mode)
+        self.moves = self.open('moves.dat', np.uint16, (capacity, ), mode)
+        self.values = self.open('values.dat', np.float32, (capacity, ), mode)
+        if mode == 'w+':
+            self.save_meta()
+
+    def open(self, name, dtype, shape, mode):
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode=mode, shape=shape)
+
+    def load_meta(self):
+        try:
+            with open(self.meta_path, 'rt') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_meta(self):
+        meta = {'capacity': self.capacity, 'plane_depth': self.plane_depth, 'head': self.head, 'size': self.size}
+        with open(self.meta_path, 'wt') as f:
+            json.dump(meta, f)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, planes, moves, values):
+        '''
+        Append positions: bit packed planes of shape (n, plane_bytes), move indexes and values
+        '''
+        n = len(moves)
+        if n > self.capacity:
+            planes, moves, values = planes[-self.capacity:], moves[-self.capacity:], values[-self.capacity:]
+            n = self.capacity
+        k = 0
+        while k < n:
+            l = min(n - k, self.capacity - self.head)
+            self.planes[self.head:self.head + l] = planes[k:k + l]
+            self.moves[self.head:self.head + l] = moves[k:k + l]
+            self.values[self.head:self.head + l] = values[k:k + l]
+            self.head = (self.head + l) % self.capacity
+            k += l
+        self.size = min(self.size + n, self.capacity)
+
+    def flush(self):
+        for column in (self.planes, self.moves, self.values):
+            column.flush()
+        self.save_meta()
+
+    def reset(self):
+        self.head = 0
+        self.size = 0
+        self.save_meta()
+
+    def get(self, indexes, mirror=None):
+        '''
+        Training data of the positions at indexes
+
+        :param mirror: boolean mask of the positions to mirror left-right
+        '''
+        indexes = np.sort(indexes)      # read the files in order
+        return training_data(self.planes[indexes], self.moves[indexes], self.values[indexes],
+                             self.plane_depth, mirror)
+
+    def sample(self, batch_size, mirror=False):
+        '''
+        Uniform sample of the buffer, with half of the positions mirrored if mirror is set
+        '''
+        indexes = np.random.randint(0, self.size, size=batch_size)
+        mask = np.random.random(batch_size) < 0.5 if mirror else None
+        return self.get(indexes, mask)
+
+class ShuffleBuffer:
+    '''
+    Bounded in-memory pool of bit packed positions, batches are drawn from it at random
+
+    Positions are added as they are decoded and removed once drawn, so a position is drawn once
+    and is mixed with the capacity positions around it in the stream.
+    '''
+    def __init__(self, capacity, plane_depth=14):
+        self.capacity = capacity
+        self.plane_depth = plane_depth
+        self.planes = np.zeros((capacity, plane_bytes(plane_depth)), dtype=np.uint8)
+        self.moves = np.zeros(capacity, dtype=np.uint16)
+        self.values = np.zeros(capacity, dtype=np.float32)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def full(self):
+        return self.size == self.capacity
+
+    def add(self, planes, moves, values):
+        '''
+        Add as many positions as fit
+
+        :return: number of positions added
+        '''
+        n = min(len(moves), self.capacity - self.size)
+        self.planes[self.size:self.size + n] = planes[:n]
+        self.moves[self.size:self.size + n] = moves[:n]
+        self.values[self.size:self.size + n] = values[:n]
+        self.size += n
+        return n
+
+    def take(self, batch_size, mirror=False):
+        '''
+        Remove batch_size random positions and return their training data
+        '''
+        batch_size = min(batch_size, self.size)
+        indexes = np.random.choice(self.size, batch_size, replace=False)
+        mask = np.random.random(batch_size) < 0.5 if mirror else None
+        data = training_data(self.planes[indexes], self.moves[indexes], self.values[indexes], self.plane_depth, mask)
+        # move the positions left at the tail into the holes
+        end = self.size - batch_size
+        taken = np.zeros(batch_size, dtype=np.bool_)
+        taken[indexes[indexes >= end] - end] = True
+        holes = indexes[indexes < end]
+        movers = np.nonzero(~taken)[0] + end
+        for column in (self.planes, self.moves, self.values):
+            column[holes] = column[movers]
+        self.size = end
+        return data
@@ -8,7 +8,7 @@ from cchess_alphazero.config import Config, PlayWithHumanConfig
 
 logger = getLogger(__name__)
 
-CMD_LIST = ['self', 'opt', 'eval', 'play', 'eval', 'sl', 'ob', 'evolve']
+CMD_LIST = ['self', 'opt', 'eval', 'play', 'eval', 'sl', 'ob', 'evolve', 'convert', 'perft']
 PIECE_STYLE_LIST = ['WOOD', 'POLISH', 'DELICATE']
 BG_STYLE_LIST = ['CANVAS', 'DROPS', 'GREEN', 'QIANHONG', 'SHEET', 'SKELETON', 'WHITE', 'WOOD']
 RANDOM_LIST = ['none', 'small', 'medium', 'large']
@@ -34,6 +34,7 @@ def create_parser():
     parser.add_argument("--skip-eval", help="skip evaluation step in evolve command", action="store_true")
     parser.add_argument("--force-gpu-opt", help="force optimization to use GPU (default: always use CPU for stability)", action="store_true")
     parser.add_argument("--cpu", help="force CPU-only training (for opt command)", action="store_true")
+    parser.add_argument("--depth", help="maximum depth for perft command", type=int, default=3)
     return parser
 
 def setup(config: Config, args):
@@ -63,7 +64,7 @@ def setup(config: Config, args):
         setup_logger(config.resource.eval_log_path)
     elif args.cmd == 'sl':
         setup_logger(config.resource.sl_log_path)
-    elif args.cmd == 'evolve':
+    elif args.cmd == 'evolve' or args.cmd == 'convert' or args.cmd == 'perft':
         setup_logger(config.resource.main_log_path)
 
 def start():
@@ -140,4 +141,9 @@ def start():
         use_gpu = True  # 默认self-play使用GPU（混合模式）
         force_gpu_opt = args.force_gpu_opt  # 只有明确指定--force-gpu-opt才强制optimize用GPU
         return evolve.start(config, args.max_iterations, args.skip_eval, use_gpu, force_gpu_opt)
-
+    elif args.cmd == 'convert':
+        from cchess_alphazero.lib.data_helper import convert_play_data
+        return convert_play_data(config.resource, config.play_data.binary_planes, config.opts.has_history)
+    elif args.cmd == 'perft':
+        from cchess_alphazero.environment import perft
+        return perft.start(config, args.depth)
@@ -224,7 +224,7 @@ class PlayWithHuman:
                 self.history.append(action)
                 if not self.env.red_to_move:
                     action = flip_move(action)
-                key = self.env.get_state()
+                key = senv.state_key(self.env.get_state())
                 p, v = self.ai.debug[key]
                 logger.info(f"check = {check}, NN value = {v:.3f}")
                 self.nn_value = v
@@ -74,6 +74,7 @@ class UCI:
         print('id version 2.4')
         print('option name gpu spin default 0 min 0 max 7')
         print('option name Threads spin default 10 min 0 max 1024')
+        print('option name SearchMode combo default threaded var threaded var batched')
         print('uciok')
         sys.stdout.flush()
         set_session_config(per_process_gpu_memory_fraction=1, allow_growth=True, 
@@ -107,6 +108,8 @@ class UCI:
             if id == 'Threads':
                 value = int(self.args[3])
                 self.config.play.search_threads = value
+            if id == 'SearchMode' and self.args[3] in ('threaded', 'batched'):
+                self.config.play.search_mode = self.args[3]
 
     def cmd_isready(self):
         if self.is_ready == True:
@@ -245,7 +248,10 @@ class UCI:
                 for i in range(len(self.history) - 1):
                     if self.history[i] == self.state:
                         no_act.append(self.history[i + 1])
-            action, value, depth = self.player.close_and_return_action(self.state, self.turns, no_act)
+            result = self.player.close_and_return_action(self.state, self.turns, no_act)
+            if result is None:
+                return      # the search has finished, search_action sends the best move
+            action, value, depth = result
             self.player = None
             self.model.close_pipes()
             self.info_best_move(action, value, depth)
@@ -275,6 +281,7 @@ class UCI:
         return use_history
 
     def search_action(self, depth, infinite):
+        player = self.player        # cmd_stop may drop self.player while searching
         no_act = None
         _, _, _, check = senv.done(self.state, need_check=True)
         logger.debug(f"Check = {check}, state = {self.state}")
@@ -285,13 +292,15 @@ class UCI:
                     if senv.will_check_or_catch(self.state, self.history[i+1]):
                         no_act.append(self.history[i + 1])
                         logger.debug(f"Foul: no act = {no_act}")
-        action, _ = self.player.action(self.state, self.turns, no_act=no_act, depth=depth, 
-                                        infinite=infinite, hist=self.history)
+        action, _ = player.action(self.state, self.turns, no_act=no_act, depth=depth, 
+                                   infinite=infinite, hist=self.history)
+        if player.job_done:
+            return      # stopped, cmd_stop has sent the best move
         if self.t:
             self.t.cancel()
-        _, value = self.player.debug[self.state]
-        depth = self.player.done_tasks // 100
-        self.player.close(wait=False)
+        _, value = player.debug[senv.state_key(self.state)]
+        depth = player.done_tasks // 100
+        player.close(wait=False)
         self.player = None
         self.model.close_pipes()
         self.info_best_move(action, value, depth)
@@ -307,15 +316,16 @@ class UCI:
         logger.debug(f"info depth {depth} score {score} time {int((self.end_time - self.start_time) * 1000)}")
         sys.stdout.flush()
         # get ponder
-        state = senv.step(self.state, action)
+        state, key = senv.step(self.state, action, senv.state_key(self.state))
         ponder = None
-        if state in self.search_tree:
-            node = self.search_tree[state]
+        if key in self.search_tree:
+            node = self.search_tree[key]
             cnt = 0
-            for mov, action_state in node.a.items():
-                if action_state.n > cnt:
-                    ponder = mov
-                    cnt = action_state.n
+            if node.legal_moves is not None:
+                for mov, n in zip(node.legal_moves, node.n):
+                    if n > cnt:
+                        ponder = ActionLabelsRed[mov]
+                        cnt = n
         if not self.is_red_turn:
             action = flip_move(action)
         action = senv.to_uci_move(action)
@@ -18,16 +18,20 @@ import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
 from cchess_alphazero.config import Config
 from cchess_alphazero.lib.data_helper import get_game_data_filenames, read_game_data_from_file
+from cchess_alphazero.lib.data_helper import is_binary_game_data, read_binary_game_data, pack_game_data, split_game_data
+from cchess_alphazero.lib.data_helper import is_sample
+from cchess_alphazero.lib.data_helper import count_positions
+from cchess_alphazero.lib.replay_buffer import ReplayBuffer, ShuffleBuffer
 from cchess_alphazero.lib.model_helper import load_best_model_weight, save_as_best_model
 from cchess_alphazero.lib.model_helper import need_to_reload_best_model_weight, save_as_next_generation_model, save_as_best_model
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move
+from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move, mirror_policy
 from cchess_alphazero.lib.tf_util import set_session_config
 from cchess_alphazero.lib.web_helper import http_request
 
 from tensorflow.keras.optimizers import SGD
 from tensorflow.keras.callbacks import TensorBoard
-from tensorflow.keras.utils import multi_gpu_model
+from tensorflow.keras.utils import multi_gpu_model, Sequence
 from tensorflow.keras import backend as K
 
 logger = getLogger(__name__)
@@ -60,9 +64,16 @@ class OptimizeWorker:
         self.opt = None
         self.count = 0
         self.eva = False
+        self.replay = None
+        self.new_positions = 0      # positions loaded by the last fill_queue
 
     def start(self):
         self.model = self.load_model()
+        if self.config.trainer.use_replay_buffer and self.config.trainer.streaming_input:
+            logger.warning("streaming_input is on, the replay buffer (use_replay_buffer) is not used")
+        elif self.config.trainer.use_replay_buffer:
+            self.replay = ReplayBuffer(self.config.resource.replay_buffer_dir, self.config.trainer.dataset_size,
+                                       28 if self.config.opts.has_history else 14)
         self.training()
 
     def training(self):
@@ -101,9 +112,16 @@ class OptimizeWorker:
                 self.filenames = deque(files)
                 logger.debug(f"Start training {len(self.filenames)} files")
                 shuffle(self.filenames)
-                self.fill_queue()
+                if self.config.trainer.streaming_input:
+                    self.new_positions = sum(count_positions(filename) for filename in self.filenames)
+                else:
+                    self.fill_queue()
                 self.update_learning_rate(total_steps)
-                if len(self.dataset[0]) > self.config.trainer.batch_size:
+                if self.config.trainer.streaming_input or self.replay is not None:
+                    positions = self.new_positions
+                else:
+                    positions = len(self.dataset[0])
+                if positions > self.config.trainer.batch_size:
                     steps = self.train_epoch(self.config.trainer.epoch_to_checkpoint)
                     total_steps += steps
                     self.save_current_model(send=False)
@@ -120,6 +138,10 @@ class OptimizeWorker:
 
     def train_epoch(self, epochs):
         tc = self.config.trainer
+        if tc.streaming_input:
+            return self.train_epoch_from_stream(epochs)
+        if self.replay is not None:
+            return self.train_epoch_from_replay(epochs)
         state_ary, policy_ary, value_ary = self.collect_all_loaded_data()
 
         # 确保在模型的图和会话中训练模型
@@ -140,6 +162,42 @@ class OptimizeWorker:
         steps = (state_ary.shape[0] // tc.batch_size) * epochs
         return steps
 
+    def train_epoch_from_replay(self, epochs):
+        '''
+        Train as many batches as the loaded positions fill, sampled uniformly from the replay buffer
+        '''
+        tc = self.config.trainer
+        steps = self.new_positions // tc.batch_size
+        if tc.mirror_augmentation:
+            steps *= 2
+        sequence = ReplaySequence(self.replay, tc.batch_size, steps, tc.mirror_augmentation)
+        model = self.mg_model if self.config.opts.use_multiple_gpus else self.model.model
+        with self.model.graph.as_default():
+            with self.model.session.as_default():
+                model.fit_generator(sequence, epochs=epochs, shuffle=False)
+        return steps * epochs
+
+    def train_epoch_from_stream(self, epochs):
+        '''
+        Train on batches decoded in the background from the files of this round, while the model trains
+        '''
+        tc = self.config.trainer
+        steps = self.new_positions // tc.batch_size
+        if tc.mirror_augmentation:
+            steps *= 2
+        stream = PlayDataStream(list(self.filenames), self.config.opts.has_history, tc.batch_size,
+                                tc.shuffle_buffer_size, tc.cleaning_processes, tc.mirror_augmentation)
+        batches = stream.batches()
+        model = self.mg_model if self.config.opts.use_multiple_gpus else self.model.model
+        try:
+            with self.model.graph.as_default():
+                with self.model.session.as_default():
+                    model.fit_generator(batches, steps_per_epoch=steps, epochs=epochs,
+                                        max_queue_size=tc.prefetch_batches)
+        finally:
+            batches.close()
+        return steps * epochs
+
     def compile_model(self):
         # 使用 tf.keras 而不是独立的 keras
         from tensorflow.keras.optimizers import SGD
@@ -170,25 +228,37 @@ class OptimizeWorker:
     def fill_queue(self):
         futures = deque()
         n = len(self.filenames)
+        if self.replay is not None:
+            load, args = load_packed_data_from_file, (self.config.opts.has_history, )
+        else:
+            load, args = load_data_from_file, (self.config.opts.has_history, self.config.trainer.mirror_augmentation)
+        self.new_positions = 0
         with ProcessPoolExecutor(max_workers=self.config.trainer.cleaning_processes) as executor:
             for _ in range(self.config.trainer.cleaning_processes):
                 if len(self.filenames) == 0:
                     break
                 filename = self.filenames.pop()
                 # logger.debug("loading data from %s" % (filename))
-                futures.append(executor.submit(load_data_from_file, filename, self.config.opts.has_history))
-            while futures and len(self.dataset[0]) < self.config.trainer.dataset_size: #fill tuples
+                futures.append(executor.submit(load, filename, *args))
+            while futures and self.new_positions < self.config.trainer.dataset_size: #fill tuples
                 _tuple = futures.popleft().result()
                 if _tuple is not None:
-                    for x, y in zip(self.dataset, _tuple):
-                        x.extend(y)
+                    if self.replay is not None:
+                        self.replay.append(*_tuple)
+                    else:
+                        for x, y in zip(self.dataset, _tuple):
+                            x.extend(y)
+                    self.new_positions += len(_tuple[0])
                 m = len(self.filenames)
                 if m > 0:
                     if (n - m) % 1000 == 0:
                         logger.info(f"Reading {n - m} files")
                     filename = self.filenames.pop()
                     # logger.debug("loading data from %s" % (filename))
-                    futures.append(executor.submit(load_data_from_file, filename, self.config.opts.has_history))
+                    futures.append(executor.submit(load, filename, *args))
+        if self.replay is not None:
+            self.replay.flush()
+            logger.info(f"Replay buffer: {self.new_positions} new positions, {len(self.replay)} in total")
 
     def collect_all_loaded_data(self):
         state_ary, policy_ary, value_ary = self.dataset
@@ -262,8 +332,10 @@ class OptimizeWorker:
                 cnt = cnt + 1
         logger.info(f"backup {len(files)} files, {cnt} empty files")
 
-def load_data_from_file(filename, use_history=False):
+def load_data_from_file(filename, use_history=False, mirror=False):
     try:
+        if is_binary_game_data(filename):
+            return expanding_columns(read_binary_game_data(filename), use_history, mirror)
         data = read_game_data_from_file(filename)
     except Exception as e:
         logger.error(f"Error when loading data {e}")
@@ -271,11 +343,31 @@ def load_data_from_file(filename, use_history=False):
         return None
     if data is None:
         return None
-    return expanding_data(data, use_history)
+    return expanding_data(data, use_history, mirror)
+
+def load_packed_data_from_file(filename, use_history=False):
+    '''
+    Positions of a play data file as (bit packed planes, move indexes, values) for the replay buffer
+    '''
+    try:
+        if is_binary_game_data(filename):
+            columns = read_binary_game_data(filename)
+        else:
+            columns = pack_game_data(split_game_data(read_game_data_from_file(filename)))
+        planes, moves, values = columns.packed_planes(use_history), np.array(columns.moves), columns.value_array()
+        mask = columns.sample_mask()
+        if mask is not None:
+            planes, moves, values = planes[mask], moves[mask], values[mask]
+        return planes, moves, values
+    except Exception as e:
+        logger.error(f"Error when loading data {e}")
+        os.remove(filename)
+        return None
 
-def expanding_data(data, use_history=False):
+def expanding_data(data, use_history=False, mirror=False):
     state = data[0]
     real_data = []
+    samples = []            # whether each position is a training sample
     action = None
     policy = None
     value = None
@@ -292,15 +384,35 @@ def expanding_data(data, use_history=False):
             logger.error(f"Expand data error {e}, item = {item}, data = {data}, state = {state}")
             return None
         real_data.append([state, policy, value])
+        samples.append(is_sample(item))
         state = senv.step(state, action)
         if use_history:
             history.append(action)
             history.append(state)
 
-    return convert_to_trainging_data(real_data, history)
-
+    return convert_to_trainging_data(real_data, history, mirror, samples)
+
+def expanding_columns(columns, use_history=False, mirror=False):
+    '''
+    Training data of a binary play data file, the stored planes are used when their depth matches
+    '''
+    n = len(columns)
+    state_array = columns.unpack_planes(use_history)
+    policy_array = np.zeros((n, len(ActionLabelsRed)), dtype=np.float32)
+    policy_array[np.arange(n), columns.moves] = 1
+    value_array = columns.value_array()
+    mask = columns.sample_mask()
+    if mask is not None:
+        state_array, policy_array, value_array = state_array[mask], policy_array[mask], value_array[mask]
+    if mirror:
+        return mirror_training_data(state_array, policy_array, value_array)
+    return state_array, policy_array, value_array
 
-def convert_to_trainging_data(data, history):
+def convert_to_trainging_data(data, history, mirror=False, samples=None):
+    '''
+    mirror: also add every position mirrored along the middle file, with its mirrored policy
+    samples: whether each position is a training sample, all positions are if None
+    '''
     state_list = []
     policy_list = []
     value_list = []
@@ -310,6 +422,9 @@ def convert_to_trainging_data(data, history):
     data_format = "channels_last"
 
     for state, policy, value in data:
+        if samples is not None and not samples[i]:
+            i += 1
+            continue
         if history is None:
             state_planes = senv.state_to_planes(state, data_format)
         else:
@@ -333,6 +448,18 @@ def convert_to_trainging_data(data, history):
         state_array = np.transpose(state_array, (0, 2, 3, 1))
         logger.debug(f"Converted data shape: {state_array.shape}")
 
+    if mirror and len(state_array):     # no sample at all gives arrays of shape (0, )
+        return mirror_training_data(state_array, policy_array, value_array)
+
+    return state_array, policy_array, value_array
+
+def mirror_training_data(state_array, policy_array, value_array):
+    '''
+    Add every position mirrored along the middle file, with its mirrored policy
+    '''
+    state_array = np.concatenate([state_array, state_array[:, :, ::-1, :]])
+    policy_array = np.concatenate([policy_array, mirror_policy(policy_array)])
+    value_array = np.concatenate([value_array, value_array])
     return state_array, policy_array, value_array
 
 def build_policy(action, flip):
@@ -346,5 +473,69 @@ def build_policy(action, flip):
         policy = flip_policy(policy)
     return list(policy)
 
-
-
+class ReplaySequence(Sequence):
+    '''
+    Batches sampled from the replay buffer, only one batch is materialized at a time
+    '''
+    def __init__(self, replay, batch_size, steps, mirror=False):
+        self.replay = replay
+        self.batch_size = batch_size
+        self.steps = steps
+        self.mirror = mirror
+
+    def __len__(self):
+        return self.steps
+
+    def __getitem__(self, idx):
+        state_ary, policy_ary, value_ary = self.replay.sample(self.batch_size, self.mirror)
+        return state_ary, [policy_ary, value_ary]
+
+class PlayDataStream:
+    '''
+    Training batches of play data files decoded by background processes and mixed in a ShuffleBuffer
+
+    The files are streamed again once all are consumed, so the number of batches is not bound to
+    the estimated number of positions.
+    '''
+    def __init__(self, filenames, use_history, batch_size, buffer_size, processes=1, mirror=False):
+        self.filenames = filenames
+        self.use_history = use_history
+        self.batch_size = batch_size
+        self.buffer_size = max(buffer_size, batch_size)
+        self.processes = processes
+        self.mirror = mirror
+
+    def decode(self, executor, filenames):
+        '''
+        Packed positions of the files in order, at most 2 files per process are decoded ahead
+        '''
+        futures = deque()
+        filenames = deque(filenames)
+        while filenames or futures:
+            while filenames and len(futures) < self.processes * 2:
+                futures.append(executor.submit(load_packed_data_from_file, filenames.pop(), self.use_history))
+            data = futures.popleft().result()
+            if data is not None:
+                yield data
+
+    def batches(self):
+        buf = ShuffleBuffer(self.buffer_size, 28 if self.use_history else 14)
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            while True:
+                filenames = list(self.filenames)
+                shuffle(filenames)
+                decoded = 0
+                for data in self.decode(executor, filenames):
+                    decoded += len(data[1])
+                    k = 0
+                    while k < len(data[1]):
+                        k += buf.add(*(column[k:] for column in data))
+                        if buf.full():
+                            state_ary, policy_ary, value_ary = buf.take(self.batch_size, self.mirror)
+                            yield state_ary, [policy_ary, value_ary]
+                while len(buf) >= self.batch_size:
+                    state_ary, policy_ary, value_ary = buf.take(self.batch_size, self.mirror)
+                    yield state_ary, [policy_ary, value_ary]
+                if not decoded:
+                    logger.error("No play data to stream")
+                    return
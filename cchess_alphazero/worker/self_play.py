@@ -1,5 +1,5 @@
 import os
-import gc
+import copy
 import numpy as np
 from time import sleep
 from collections import deque
@@ -14,15 +14,16 @@ from threading import Thread
 
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, VisitState, NodePool
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
 from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move
-from cchess_alphazero.lib.data_helper import get_game_data_filenames, write_game_data_to_file
+from cchess_alphazero.lib.data_helper import get_game_data_filenames, write_game_data_to_file, write_binary_game_data
 from cchess_alphazero.lib.model_helper import load_model_weight, save_as_best_model, load_best_model_weight_from_internet
 from cchess_alphazero.lib.tf_util import set_session_config
 from cchess_alphazero.lib.web_helper import upload_file
+from cchess_alphazero.worker.self_play_game import SelfPlayGame, ConcurrentGames
 
 logger = getLogger(__name__)
 
@@ -68,6 +69,7 @@ class SelfPlayWorker:
         self.buffer = []
         self.pid = os.getpid()
         self.use_history = use_history
+        self.node_pool = None
 
     def start(self):
         self.pid = os.getpid()
@@ -77,6 +79,9 @@ class SelfPlayWorker:
 
         idx = 1
         self.buffer = []
+        if self.config.play.concurrent_games > 1:
+            return self.play_concurrent_games()
+        self.node_pool = NodePool()     # nodes are recycled game after game
         search_tree = defaultdict(VisitState)
 
         while True:
@@ -99,132 +104,85 @@ class SelfPlayWorker:
             idx % self.config.play.reset_mtcs_info_per_game == 0:
             search_tree = defaultdict(VisitState)
 
-        if random() > self.config.play.enable_resign_rate:
-            enable_resign = True
-        else:
-            enable_resign = False
-
-        self.player = CChessPlayer(self.config, search_tree=search_tree, pipes=pipes, 
-                                    enable_resign=enable_resign, debugging=False, use_history=self.use_history)
-
-        state = senv.INIT_STATE
-        history = [state]
-        # policys = [] 
-        value = 0
-        turns = 0       # even == red; odd == black
-        game_over = False
-        final_move = None
-        no_eat_count = 0
-        check = False
-        no_act = []
-        increase_temp = False
-
-        while not game_over:
-            start_time = time()
-            action, policy = self.player.action(state, turns, no_act, increase_temp=increase_temp)
-            end_time = time()
-            if action is None:
-                logger.debug(f"{turns % 2} (0 = red; 1 = black) has resigned!")
-                value = -1
-                break
-            # if self.config.opts.log_move:
-            #     logger.info(f"Process{self.pid} Playing: {turns % 2}, action: {action}, time: {(end_time - start_time):.1f}s")
-            # logger.info(f"Process{self.pid} Playing: {turns % 2}, action: {action}, time: {(end_time - start_time):.1f}s")
-            history.append(action)
-            # policys.append(policy)
-            try:
-                state, no_eat = senv.new_step(state, action)
-            except Exception as e:
-                logger.error(f"{e}, no_act = {no_act}, policy = {policy}")
-                game_over = True
-                value = 0
-                break
-            turns += 1
-            if no_eat:
-                no_eat_count += 1
-            else:
-                no_eat_count = 0
-            history.append(state)
-
-            if no_eat_count >= 120 or turns / 2 >= self.config.play.max_game_length:
-                game_over = True
-                value = 0
-            else:
-                game_over, value, final_move, check = senv.done(state, need_check=True)
-                if not game_over:
-                    if not senv.has_attack_chessman(state):
-                        logger.info(f"双方无进攻子力，作和。state = {state}")
-                        game_over = True
-                        value = 0
-                increase_temp = False
-                no_act = []
-                if not game_over and not check and state in history[:-1]:
-                    free_move = defaultdict(int)
-                    for i in range(len(history) - 1):
-                        if history[i] == state:
-                            if senv.will_check_or_catch(state, history[i+1]):
-                                no_act.append(history[i + 1])
-                            elif not senv.be_catched(state, history[i+1]):
-                                increase_temp = True
-                                free_move[state] += 1
-                                if free_move[state] >= 3:
-                                    # 作和棋处理
-                                    game_over = True
-                                    value = 0
-                                    logger.info("闲着循环三次，作和棋处理")
-                                    break
-
-        if final_move:
-            # policy = self.build_policy(final_move, False)
-            history.append(final_move)
-            # policys.append(policy)
-            state = senv.step(state, final_move)
-            turns += 1
-            value = -value
-            history.append(state)
+        self.player = self.new_player(pipes, search_tree, self.node_pool)
+        game = SelfPlayGame(self.config, self.player)
+        while not game.game_over:
+            action, policy = game.action()
+            game.play(action, policy)
 
-        self.player.close()
+        v, store, data = game.result()
         del search_tree
         del self.player
-        gc.collect()
-        if turns % 2 == 1:  # balck turn
-            value = -value
-
-        v = value
-        if turns < 10:
-            if random() > 0.9:
-                store = True
-            else:
-                store = False
-        else:
-            store = True
-
+        self.node_pool.reset()
         if store:
-            data = [history[0]]
-            for i in range(turns):
-                k = i * 2
-                data.append([history[k + 1], value])
-                value = -value
             self.save_play_data(idx, data)
 
         self.cur_pipes.append(pipes)
         self.remove_play_data()
-        return v, turns, state, store
+        return v, game.turns, game.state, store
+
+    def new_player(self, pipes, search_tree, node_pool, play_config=None):
+        if random() > self.config.play.enable_resign_rate:
+            enable_resign = True
+        else:
+            enable_resign = False
+        return CChessPlayer(self.config, search_tree=search_tree, pipes=pipes, play_config=play_config,
+                            enable_resign=enable_resign, debugging=False, use_history=self.use_history,
+                            node_pool=node_pool)
+
+    def play_concurrent_games(self):
+        '''
+        Play concurrent_games games at once with the batched search, one prediction serves the leaves
+        of all games through the single pipe of this process
+        '''
+        pipes = self.cur_pipes.pop()
+        play_config = copy.copy(self.config.play)
+        play_config.search_mode = 'batched'
+        pools = []          # node pools of finished games, reused by the next ones
+        idx = 1
+
+        def new_game():
+            pool = pools.pop() if pools else NodePool()
+            player = self.new_player(None, defaultdict(VisitState), pool, play_config)
+            return SelfPlayGame(self.config, player)
+
+        games = ConcurrentGames(pipes, self.config.play.concurrent_games, new_game)
+        while True:
+            for game in games.step():
+                value, store, data = game.result()
+                game.player.node_pool.reset()
+                pools.append(game.player.node_pool)
+                logger.debug(f"Process {self.pid}-{self.id} play game {idx} time={(time() - game.start_time):.1f} sec, "
+                             f"turn={game.turns / 2}, winner = {value:.2f} (1 = red, -1 = black, 0 draw)")
+                if store:
+                    self.save_play_data(idx, data)
+                    self.remove_play_data()
+                    idx += 1
 
     def save_play_data(self, idx, data):
-        self.buffer += data
+        pc = self.config.play_data
+        if pc.binary_format:
+            self.buffer.append(data)
+        else:
+            self.buffer += data
 
-        if not idx % self.config.play_data.nb_game_in_file == 0:
+        if not idx % pc.nb_game_in_file == 0:
             return
 
         rc = self.config.resource
         utc_dt = datetime.utcnow().replace(tzinfo=timezone.utc)
         bj_dt = utc_dt.astimezone(timezone(timedelta(hours=8)))
         game_id = bj_dt.strftime("%Y%m%d-%H%M%S.%f")
-        filename = rc.play_data_filename_tmpl % game_id
+        if pc.binary_format:
+            filename = rc.play_data_binary_filename_tmpl % game_id
+        else:
+            filename = rc.play_data_filename_tmpl % game_id
         path = os.path.join(rc.play_data_dir, filename)
         logger.info(f"Process {self.pid} save play data to {path}")
-        write_game_data_to_file(path, self.buffer)
+        if pc.binary_format:
+            write_binary_game_data(path, self.buffer, pc.binary_planes, self.use_history)
+        else:
+            write_game_data_to_file(path, self.buffer)
         if self.config.internet.distributed:
             upload_worker = Thread(target=self.upload_play_data, args=(path, filename), name="upload_worker")
             upload_worker.daemon = True
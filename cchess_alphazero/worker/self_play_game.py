@@ -0,0 +1,231 @@
+'''
+Rules and record of a self-play game, and many games advanced together in one process
+
+ConcurrentGames runs the batched search of every game as a generator (CChessPlayer.action_steps)
+and answers the prediction requests of all games with one batch, so a single inference call
+serves the leaves of all games and a process needs a single pipe.
+'''
+from collections import defaultdict
+from logging import getLogger
+from random import random
+from time import time
+
+import numpy as np
+
+import cchess_alphazero.environment.static_env as senv
+from cchess_alphazero.agent.shm_pipe import SharedMemoryPipe
+
+logger = getLogger(__name__)
+
+MAX_PREDICT_ROWS = 512      # rows of a prediction batch sent through a plain pipe
+
+class SelfPlayGame:
+    '''
+    State of a self-play game, the moves are chosen by player
+    '''
+    def __init__(self, config, player):
+        self.config = config
+        self.player = player
+        self.start_time = time()
+        self.state = senv.INIT_STATE
+        self.key = senv.state_key(self.state)
+        self.history = [self.key]
+        self.played = defaultdict(list)     # key -> moves played from the position, for repetitions
+        self.value = 0
+        self.turns = 0                      # even == red; odd == black
+        self.game_over = False
+        self.final_move = None
+        self.no_eat_count = 0
+        self.no_act = []
+        self.increase_temp = False
+        self.samples = []                   # whether each move was chosen by a full search, not forced
+        self.full_search = True
+
+    def simulations(self):
+        '''
+        Playout cap randomization: a move is searched with simulation_num_per_move with probability
+        full_search_rate, else with fast_simulation_num_per_move and is not a training sample
+        '''
+        pc = self.config.play
+        self.full_search = pc.full_search_rate >= 1 or random() < pc.full_search_rate
+        return None if self.full_search else pc.fast_simulation_num_per_move
+
+    def action(self):
+        return self.player.action(self.state, self.turns, self.no_act, depth=self.simulations(),
+                                  increase_temp=self.increase_temp)
+
+    def action_steps(self):
+        return self.player.action_steps(self.state, self.turns, self.no_act, depth=self.simulations(),
+                                        increase_temp=self.increase_temp)
+
+    def play(self, action, policy):
+        '''
+        Play the action chosen by the player, None if it resigns, and adjudicate the position
+        '''
+        if action is None:
+            logger.debug(f"{self.turns % 2} (0 = red; 1 = black) has resigned!")
+            self.value = -1
+            self.game_over = True
+            return
+        self.history.append(action)
+        self.samples.append(self.full_search and not self.player.forced)
+        self.played[self.key].append(action)
+        try:
+            self.state, no_eat, self.key = senv.new_step(self.state, action, self.key)
+        except Exception as e:
+            logger.error(f"{e}, no_act = {self.no_act}, policy = {policy}")
+            self.game_over = True
+            self.value = 0
+            return
+        self.turns += 1
+        if no_eat:
+            self.no_eat_count += 1
+        else:
+            self.no_eat_count = 0
+        self.history.append(self.key)
+
+        if self.no_eat_count >= 120 or self.turns / 2 >= self.config.play.max_game_length:
+            self.game_over = True
+            self.value = 0
+            return
+        state, key = self.state, self.key
+        self.game_over, self.value, self.final_move, check = senv.done(state, need_check=True)
+        if not self.game_over:
+            if not senv.has_attack_chessman(state):
+                logger.info(f"双方无进攻子力，作和。state = {state}")
+                self.game_over = True
+                self.value = 0
+        self.increase_temp = False
+        self.no_act = []
+        if not self.game_over and not check and key in self.played:
+            free_move = defaultdict(int)
+            for act in self.played[key]:
+                if senv.will_check_or_catch(state, act, key):
+                    self.no_act.append(act)
+                elif not senv.be_catched(state, act):
+                    self.increase_temp = True
+                    free_move[state] += 1
+                    if free_move[state] >= 3:
+                        # 作和棋处理
+                        self.game_over = True
+                        self.value = 0
+                        logger.info("闲着循环三次，作和棋处理")
+                        break
+
+    def result(self):
+        '''
+        Play the final move if any and close the player
+
+        :return: (value for red, whether the game is stored, play data [init state, [move, value], ...]),
+            the moves of fast searches are stored as [move, value, 0], they only count for the game result
+        '''
+        if self.final_move:
+            self.history.append(self.final_move)
+            self.samples.append(True)
+            self.state, self.key = senv.step(self.state, self.final_move, self.key)
+            self.turns += 1
+            self.value = -self.value
+            self.history.append(self.key)
+        self.player.close()
+
+        turns = self.turns
+        value = self.value
+        if turns % 2 == 1:  # balck turn
+            value = -value
+        v = value
+        if turns < 10:
+            store = random() > 0.9
+        else:
+            store = True
+        data = None
+        if store:
+            data = [senv.INIT_STATE]
+            for i in range(turns):
+                k = i * 2
+                data.append([self.history[k + 1], value] if self.samples[i] else [self.history[k + 1], value, 0])
+                value = -value
+        return v, store, data
+
+class ConcurrentGames:
+    '''
+    Games advanced together with the batched search, finished games are replaced by new_game()
+
+    :param pipe: pipe to the model API, the prediction requests of all games go through it
+    :param new_game: returns a new SelfPlayGame whose player uses the batched search
+    '''
+    def __init__(self, pipe, num_games, new_game):
+        self.pipe = pipe
+        self.new_game = new_game
+        if isinstance(pipe, SharedMemoryPipe):
+            self.max_rows = pipe.capacity
+        else:
+            self.max_rows = MAX_PREDICT_ROWS
+        self.games = []
+        self.steps = []         # action_steps generator of every game
+        self.requests = []      # pending prediction request of every game
+        self.finished = []      # games finished by the last step()
+        for _ in range(num_games):
+            game = new_game()
+            self.games.append(game)
+            self.steps.append(game.action_steps())
+            self.requests.append(None)
+            self.advance(len(self.games) - 1, None)
+
+    def advance(self, i, rets):
+        '''
+        Resume the search of game i with the predictions of its request, until it requests again
+        '''
+        while True:
+            try:
+                self.requests[i] = self.steps[i].send(rets)
+                return
+            except StopIteration as e:
+                rets = None
+                game = self.games[i]
+                game.play(*e.value)
+                if game.game_over:
+                    self.finished.append(game)
+                    game = self.new_game()
+                    self.games[i] = game
+                self.steps[i] = game.action_steps()
+
+    def step(self):
+        '''
+        Evaluate the pending requests of all games, a batch holds as many whole requests as fit into
+        the pipe, and resume their searches
+
+        :return: games finished in this step
+        '''
+        self.finished = []
+        pending = list(range(len(self.games)))
+        while pending:
+            batch, rows = [], 0
+            while pending and (not batch or rows + len(self.requests[pending[0]][0]) <= self.max_rows):
+                i = pending.pop(0)
+                batch.append(i)
+                rows += len(self.requests[i][0])
+            self.predict(batch, rows)
+        return self.finished
+
+    def predict(self, batch, rows):
+        if isinstance(self.pipe, SharedMemoryPipe):
+            t_data = self.pipe.input_rows(rows)
+        else:
+            t_data = None
+        parts, keys = [], []
+        k = 0
+        for i in batch:
+            entries, mirrored, cache_keys = self.requests[i]
+            out = t_data[k:k + len(entries)] if t_data is not None else None
+            parts.append(self.games[i].player.encode_batch(entries, mirrored, out))
+            keys += cache_keys
+            k += len(entries)
+        if t_data is None:
+            t_data = np.concatenate(parts)
+        self.pipe.send((t_data, keys))
+        rets = self.pipe.recv()
+        k = 0
+        for i in batch:
+            n = len(self.requests[i][0])
+            self.advance(i, rets[k:k + n])
+            k += n
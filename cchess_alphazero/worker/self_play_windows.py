@@ -1,5 +1,4 @@
 import os
-import gc
 import numpy as np
 from collections import deque
 from concurrent.futures import ProcessPoolExecutor
@@ -20,7 +19,7 @@ from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
 from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move
-from cchess_alphazero.lib.data_helper import get_game_data_filenames, write_game_data_to_file
+from cchess_alphazero.lib.data_helper import get_game_data_filenames, write_game_data_to_file, write_binary_game_data
 from cchess_alphazero.lib.model_helper import load_model_weight, save_as_best_model, load_best_model_weight_from_internet
 from cchess_alphazero.lib.tf_util import set_session_config
 from cchess_alphazero.lib.web_helper import upload_file
@@ -79,7 +78,10 @@ class SelfPlayWorker:
                 value = rst[1]
                 logger.debug(f"对局完成：对局ID {game_idx} 耗时{(end_time - start_time):.1f} 秒, "
                          f"{turns / 2}回合, 胜者 = {value:.2f} (1 = 红, -1 = 黑, 0 = 和)")
-                self.buffer += data
+                if self.config.play_data.binary_format:
+                    self.buffer.append(data)
+                else:
+                    self.buffer += data
 
                 if (game_idx % self.config.play_data.nb_game_in_file) == 0:
                     self.flush_buffer()
@@ -113,11 +115,18 @@ class SelfPlayWorker:
 
     def flush_buffer(self):
         rc = self.config.resource
+        pc = self.config.play_data
         game_id = datetime.now().strftime("%Y%m%d-%H%M%S.%f")
-        filename = rc.play_data_filename_tmpl % game_id
+        if pc.binary_format:
+            filename = rc.play_data_binary_filename_tmpl % game_id
+        else:
+            filename = rc.play_data_filename_tmpl % game_id
         path = os.path.join(rc.play_data_dir, filename)
         logger.info("保存博弈数据到 %s" % (path))
-        write_game_data_to_file(path, self.buffer)
+        if pc.binary_format:
+            write_binary_game_data(path, self.buffer, pc.binary_planes, self.use_history)
+        else:
+            write_game_data_to_file(path, self.buffer)
         if self.config.internet.distributed:
             upload_worker = Thread(target=self.upload_play_data, args=(path, filename))
             upload_worker.start()
@@ -166,7 +175,9 @@ def self_play_buffer(config, cur, use_history=False) -> (tuple, list):
                             enable_resign=enable_resign, debugging=False, use_history=use_history)
 
     state = senv.INIT_STATE
-    history = [state]
+    key = senv.state_key(state)
+    history = [key]
+    played = defaultdict(list)     # key -> moves played from the position, for repetitions
     # policys = []
     value = 0
     turns = 0
@@ -188,8 +199,9 @@ def self_play_buffer(config, cur, use_history=False) -> (tuple, list):
         print(f" 博弈中: 回合{turns / 2 + 1} {'红方走棋' if turns % 2 == 0 else '黑方走棋'}, 着法: {action}, 用时: {(end_time - start_time):.1f}s")
         # policys.append(policy)
         history.append(action)
+        played[key].append(action)
         try:
-            state, no_eat = senv.new_step(state, action)
+            state, no_eat, key = senv.new_step(state, action, key)
         except Exception as e:
             logger.error(f"{e}, no_act = {no_act}, policy = {policy}")
             game_over = True
@@ -200,7 +212,7 @@ def self_play_buffer(config, cur, use_history=False) -> (tuple, list):
             no_eat_count += 1
         else:
             no_eat_count = 0
-        history.append(state)
+        history.append(key)
 
         if no_eat_count >= 120 or turns / 2 >= config.play.max_game_length:
             game_over = True
@@ -214,40 +226,38 @@ def self_play_buffer(config, cur, use_history=False) -> (tuple, list):
                     logger.info(f"双方无进攻子力，作和。state = {state}")
                     game_over = True
                     value = 0
-            if not game_over and not check and state in history[:-1]:
+            if not game_over and not check and key in played:
                 free_move = defaultdict(int)
-                for i in range(len(history) - 1):
-                    if history[i] == state:
-                        if senv.will_check_or_catch(state, history[i+1]):
-                            no_act.append(history[i + 1])
-                        elif not senv.be_catched(state, history[i+1]):
-                            increase_temp = True
-                            free_move[state] += 1
-                            if free_move[state] >= 3:
-                                # 作和棋处理
-                                game_over = True
-                                value = 0
-                                logger.info("闲着循环三次，作和棋处理")
-                                break
+                for act in played[key]:
+                    if senv.will_check_or_catch(state, act, key):
+                        no_act.append(act)
+                    elif not senv.be_catched(state, act):
+                        increase_temp = True
+                        free_move[state] += 1
+                        if free_move[state] >= 3:
+                            # 作和棋处理
+                            game_over = True
+                            value = 0
+                            logger.info("闲着循环三次，作和棋处理")
+                            break
 
     if final_move:
         # policy = build_policy(final_move, False)
         history.append(final_move)
         # policys.append(policy)
-        state = senv.step(state, final_move)
+        state, key = senv.step(state, final_move, key)
         turns += 1
         value = -value
-        history.append(state)
+        history.append(key)
 
     player.close()
     del player
-    gc.collect()
 
     if turns % 2 == 1:  # balck turn
         value = -value
 
     v = value
-    data = [history[0]]
+    data = [senv.INIT_STATE]
     for i in range(turns):
         k = i * 2
         data.append([history[k + 1], value])